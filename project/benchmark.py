@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import uuid
+import shutil
+import platform
+import argparse
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import pandas as pd
+from generate_data import generate_dataset, COUNTRY_LOCATIONS
+from pipeline import configure_logging, build_pipeline, run_graph, load_manifest, WEEK_WINDOW
+
+# Default input sizes in daily weather rows; every size gets a tenth as many fire alert rows
+DEFAULT_SIZES = [100_000, 1_000_000, 10_000_000]
+
+# Relative slowdown or memory growth reported as a regression
+DEFAULT_TOLERANCE = 0.10
+
+# Commit the benchmark runs against, if the tree is a git checkout
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Generate the synthetic input files of one size, reusing them when they already exist
+def prepare_inputs(work_dir, weather_rows, n_countries, start_year, end_year):
+    data_dir = os.path.join(work_dir, f'data-{weather_rows}-{n_countries}-{start_year}-{end_year}')
+    weather_csv = os.path.join(data_dir, 'daily_weather_data.csv')
+    fire_alerts_csv = os.path.join(data_dir, 'viirs_fire_alerts__count.csv')
+    if not (os.path.exists(weather_csv) and os.path.exists(fire_alerts_csv)):
+        generate_dataset(data_dir, weather_rows, max(weather_rows // 10, 1), n_countries, start_year, end_year)
+    return weather_csv, fire_alerts_csv
+
+# Run the processing and merge stages on local inputs and return their metrics.
+# Runs in a fresh worker process so the peak RSS belongs to this size alone
+def run_pipeline_once(weather_csv, fire_alerts_csv, output_dir, countries, window, workers, sqlite, processes=1):
+    configure_logging(quiet=True)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+
+    metrics = []
+    stages = build_pipeline(output_dir, load_manifest(output_dir), countries=countries, window=window, refresh=True,
+                            sqlite_path=os.path.join(output_dir, 'weekly.sqlite') if sqlite else None,
+                            processes=processes)
+    run_graph(stages, results={'download_weather': weather_csv, 'download_fire_alerts': fire_alerts_csv},
+              max_workers=workers, metrics=metrics)
+    return metrics
+
+# Benchmark every size and append one record per stage to `results_file`
+def run_benchmarks(sizes, work_dir, results_file, n_countries, start_year, end_year, countries, window,
+                   workers, repeat, sqlite, processes=1):
+    run_id = uuid.uuid4().hex[:12]
+    run_info = {
+        'run_id': run_id,
+        'run_at': datetime.now(timezone.utc).isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'countries': n_countries,
+        'years': [start_year, end_year],
+        'aggregated_countries': countries,
+        'window': window,
+        'workers': workers,
+        'processes': processes
+    }
+
+    records = []
+    for weather_rows in sizes:
+        weather_csv, fire_alerts_csv = prepare_inputs(work_dir, weather_rows, n_countries, start_year, end_year)
+        for iteration in range(repeat):
+            output_dir = os.path.join(work_dir, 'output')
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                stage_metrics = pool.submit(run_pipeline_once, weather_csv, fire_alerts_csv, output_dir,
+                                            countries, window, workers, sqlite, processes).result()
+            for metrics in stage_metrics:
+                records.append({**run_info, 'size': weather_rows, 'iteration': iteration, **metrics})
+            total = sum(metrics['wall_s'] for metrics in stage_metrics)
+            print(f"{weather_rows:>12,} rows, iteration {iteration}: {total:.2f}s of stage time")
+
+    with open(results_file, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    print(f"Benchmark run {run_id} appended to {results_file}")
+    return run_id
+
+# Compare the median stage wall time and peak RSS of a run with a baseline run (by default the
+# latest run and the one before it) and return whether any stage regressed beyond `tolerance`
+def compare_runs(results_file, run_id=None, baseline_id=None, tolerance=DEFAULT_TOLERANCE):
+    results = pd.read_json(results_file, lines=True)
+    run_order = results.drop_duplicates('run_id').sort_values('run_at')['run_id'].tolist()
+    run_id = run_id or run_order[-1]
+    if baseline_id is None:
+        earlier = run_order[:run_order.index(run_id)]
+        if not earlier:
+            print(f"No earlier run to compare {run_id} with")
+            return False
+        baseline_id = earlier[-1]
+
+    summary = results[results['run_id'].isin([run_id, baseline_id])].groupby(
+        ['run_id', 'size', 'stage'])[['wall_s', 'peak_rss_mb']].median()
+    current = summary.loc[run_id]
+    baseline = summary.loc[baseline_id]
+    joined = current.join(baseline, lsuffix='', rsuffix='_baseline', how='inner')
+    joined['wall_ratio'] = joined['wall_s'] / joined['wall_s_baseline']
+    joined['rss_ratio'] = joined['peak_rss_mb'] / joined['peak_rss_mb_baseline']
+    joined['regression'] = (joined['wall_ratio'] > 1 + tolerance) | (joined['rss_ratio'] > 1 + tolerance)
+
+    print(f"Run {run_id} compared with {baseline_id}:")
+    print(joined.round(3).to_string())
+    return bool(joined['regression'].any())
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data, offline.')
+    parser.add_argument('--work-dir', type=str, required=True, help='Directory for the synthetic inputs and pipeline outputs.')
+    parser.add_argument('--results', type=str, default='benchmark_results.jsonl', help='JSON lines file the results are appended to.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Numbers of daily weather rows to benchmark.')
+    parser.add_argument('--countries', type=int, default=len(COUNTRY_LOCATIONS), help='Number of countries in the synthetic data.')
+    parser.add_argument('--start-year', type=int, default=1990, help='First year of the synthetic history.')
+    parser.add_argument('--end-year', type=int, default=2023, help='Last year of the synthetic history.')
+    parser.add_argument('--all-countries', action='store_true', help='Aggregate every country instead of Greece only.')
+    parser.add_argument('--whole-history', action='store_true', help='Analyse every week instead of the default window.')
+    parser.add_argument('--workers', type=int, default=4, help='Number of stages run concurrently.')
+    parser.add_argument('--processes', type=int, default=1, help='Worker processes each raw file is aggregated with.')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per size.')
+    parser.add_argument('--sqlite', action='store_true', help='Include the SQLite sink.')
+    parser.add_argument('--compare', action='store_true', help='Compare this run with the previous one and fail on regressions.')
+    parser.add_argument('--compare-only', action='store_true', help='Only compare the two latest runs in the results file.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Relative change reported as a regression.')
+    args = parser.parse_args()
+
+    run_id = None
+    if not args.compare_only:
+        os.makedirs(args.work_dir, exist_ok=True)
+        run_id = run_benchmarks(
+            args.sizes, args.work_dir, args.results, args.countries, args.start_year, args.end_year,
+            None if args.all_countries else ['Greece'], None if args.whole_history else WEEK_WINDOW,
+            args.workers, args.repeat, args.sqlite, args.processes
+        )
+
+    if args.compare or args.compare_only:
+        if compare_runs(args.results, run_id=run_id, tolerance=args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+import requests
+
+logger = logging.getLogger('pipeline')
+
+# Bytes copied at a time while downloading
+FETCH_BLOCK_SIZE = 1 << 20
+
+# Kaggle endpoint serving a single file of a dataset (large files are served as <file>.zip)
+KAGGLE_DOWNLOAD_URL = 'https://www.kaggle.com/api/v1/datasets/download/{dataset}/{file_name}'
+
+# A file as the backend stores it: its name (e.g. with a .zip suffix), size, SHA-256 and a version
+# identifying its content, such as an HTTP ETag (None when unknown)
+RemoteFile = namedtuple('RemoteFile', ['name', 'size', 'checksum', 'version'])
+
+# Where files are fetched from: `stat(dataset, file_name)` describes a file and
+# `open(dataset, file_name, offset, version)` returns a byte stream of it from `offset` together with
+# the offset the stream actually starts at (0 when the backend cannot resume, or when the file no
+# longer is at `version`)
+Backend = namedtuple('Backend', ['stat', 'open'])
+
+# SHA-256 of a file's content
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(FETCH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Kaggle over HTTP, with one session authenticated on first use and shared by all downloads.
+# Kaggle publishes no checksum, so local copies are matched on the remote size and ETag (or Last-Modified)
+def kaggle_backend():
+    lock = threading.Lock()
+    client = {}
+
+    def session():
+        with lock:
+            if 'session' not in client:
+                # Imported here so the pipeline can run offline on local files without the Kaggle client
+                from kaggle.api.kaggle_api_extended import KaggleApi
+                api = KaggleApi()
+                api.authenticate()
+                client['session'] = requests.Session()
+                client['session'].auth = (api.config_values['username'], api.config_values['key'])
+            return client['session']
+
+    def get(dataset, file_name, offset=0, version=None):
+        headers = {}
+        if offset:
+            # If-Range makes the server send the whole file instead of the range when it changed
+            headers['Range'] = f'bytes={offset}-'
+            if version is not None:
+                headers['If-Range'] = version
+        response = session().get(KAGGLE_DOWNLOAD_URL.format(dataset=dataset, file_name=file_name),
+                                 headers=headers, stream=True, timeout=60)
+        response.raise_for_status()
+        return response
+
+    # The headers are read with a HEAD request; a server that refuses HEAD (e.g. a storage URL signed
+    # for GET only) gets a GET whose body is never read
+    def stat(dataset, file_name):
+        response = session().head(KAGGLE_DOWNLOAD_URL.format(dataset=dataset, file_name=file_name),
+                                  allow_redirects=True, timeout=60)
+        if response.status_code in (403, 405):
+            response.close()
+            response = get(dataset, file_name)
+        with response:
+            response.raise_for_status()
+            name = os.path.basename(requests.utils.urlparse(response.url).path) or file_name
+            size = response.headers.get('Content-Length')
+            version = response.headers.get('ETag') or response.headers.get('Last-Modified')
+            return RemoteFile(name, None if size is None else int(size), None, version)
+
+    def open_stream(dataset, file_name, offset, version=None):
+        response = get(dataset, file_name, offset, version)
+        return response.raw, offset if response.status_code == 206 else 0
+
+    return Backend(stat, open_stream)
+
+# A local directory standing in for Kaggle, laid out as <root>/<owner>/<dataset>/<file> (or <file>.zip)
+def mirror_backend(root):
+    def stored_path(dataset, file_name):
+        for name in (file_name, f'{file_name}.zip'):
+            path = os.path.join(root, dataset, name)
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError(f"{file_name} of {dataset} not found in the mirror {root}")
+
+    def stat(dataset, file_name):
+        path = stored_path(dataset, file_name)
+        checksum = sha256_file(path)
+        return RemoteFile(os.path.basename(path), os.path.getsize(path), checksum, checksum)
+
+    def open_stream(dataset, file_name, offset, version=None):
+        f = open(stored_path(dataset, file_name), 'rb')
+        f.seek(offset)
+        return f, offset
+
+    return Backend(stat, open_stream)
+
+# Version of the remote file a download came from (its size and ETag or checksum), recorded next
+# to it in <path>.json: for an interrupted download <name>.part, and for a complete local copy <name>;
+# None when unknown
+def recorded_version(path):
+    try:
+        with open(f'{path}.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Whether the local copy is the remote file: it must have the remote size and checksum where the
+# backend publishes them, and come from the same version of it where both versions are known.
+# Without a remote size or checksum (e.g. Kaggle sending no Content-Length) the recorded version
+# alone decides, as long as the local copy still has the size it was downloaded with
+def local_copy_matches(local_path, remote, checksum):
+    if not os.path.exists(local_path):
+        return False
+    recorded = recorded_version(local_path)
+    if remote.version is not None and recorded is not None and recorded['version'] != remote.version:
+        return False
+    if remote.size is None and remote.checksum is None:
+        return remote.version is not None and recorded is not None and recorded['size'] == os.path.getsize(local_path)
+    if remote.size is not None and remote.size != os.path.getsize(local_path):
+        return False
+    return remote.checksum is None or checksum(local_path) == remote.checksum
+
+# Fetch `file_name` of `dataset` into `output_folder` and return its local path (a .zip when the
+# backend stores it zipped; the readers stream rows straight out of the archive) and the bytes transferred.
+# A local copy matching the remote file (see local_copy_matches) is kept as is; an interrupted download
+# left as <name>.part is resumed from where it stopped, and only renamed once complete. It is only
+# resumed when it came from the same version of the remote file (size and ETag or checksum, kept in
+# <name>.part.json), so a file that changed in between is downloaded again from the start. The version
+# of a complete download is kept in <name>.json.
+# `checksum` hashes the local copy (SHA-256 of its content by default)
+def fetch_file(backend, dataset, file_name, output_folder, checksum=None):
+    checksum = checksum or sha256_file
+    remote = backend.stat(dataset, file_name)
+    local_path = os.path.join(output_folder, remote.name)
+    if local_copy_matches(local_path, remote, checksum):
+        logger.info("Skipping download of %s: local copy matches the remote file", remote.name)
+        return local_path, 0
+
+    partial_path = f'{local_path}.part'
+    version = {'size': remote.size, 'version': remote.version}
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    if remote.version is None or recorded_version(partial_path) != version or \
+            (remote.size is not None and offset > remote.size):
+        offset = 0
+    if not offset:
+        with open(f'{partial_path}.json', 'w') as f:
+            json.dump(version, f)
+    stream, offset = backend.open(dataset, file_name, offset, remote.version)
+    if offset:
+        logger.info("Resuming download of %s at byte %d", remote.name, offset)
+    else:
+        logger.info("Downloading %s from %s", remote.name, dataset)
+
+    with stream, open(partial_path, 'ab' if offset else 'wb') as f:
+        shutil.copyfileobj(stream, f, FETCH_BLOCK_SIZE)
+    transferred = os.path.getsize(partial_path) - offset
+    if remote.size is not None and os.path.getsize(partial_path) != remote.size:
+        raise IOError(f"Incomplete download of {remote.name}: {os.path.getsize(partial_path)} of {remote.size} bytes")
+    if remote.checksum is not None and sha256_file(partial_path) != remote.checksum:
+        os.remove(partial_path)
+        os.remove(f'{partial_path}.json')
+        raise IOError(f"Checksum mismatch for {remote.name}")
+    os.replace(partial_path, local_path)
+    with open(f'{local_path}.json', 'w') as f:
+        json.dump({'size': os.path.getsize(local_path), 'version': remote.version}, f)
+    os.remove(f'{partial_path}.json')
+    return local_path, transferred
@@ -0,0 +1,133 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+# Countries of the synthetic weather data with the latitude/longitude around which their cities lie
+COUNTRY_LOCATIONS = {
+    'Greece': (38.5, 23.0), 'Italy': (42.5, 12.5), 'Spain': (40.0, -3.7), 'Portugal': (39.5, -8.0),
+    'France': (46.5, 2.5), 'Turkey': (39.0, 35.0), 'Cyprus': (35.0, 33.0), 'Malta': (35.9, 14.4),
+    'Croatia': (45.1, 15.2), 'Albania': (41.2, 20.0), 'Montenegro': (42.7, 19.3), 'Slovenia': (46.1, 14.9),
+    'Tunisia': (34.0, 9.5), 'Algeria': (28.0, 2.6), 'Morocco': (31.8, -7.1), 'Egypt': (26.8, 30.8),
+    'Libya': (26.3, 17.2), 'Israel': (31.0, 34.8), 'Lebanon': (33.9, 35.9), 'Syria': (34.8, 38.9),
+    'Germany': (51.2, 10.4), 'Austria': (47.5, 14.6), 'Switzerland': (46.8, 8.2), 'Poland': (51.9, 19.1),
+    'Hungary': (47.2, 19.5), 'Romania': (45.9, 25.0), 'Bulgaria': (42.7, 25.5), 'Serbia': (44.0, 21.0),
+    'Norway': (60.5, 8.5), 'Sweden': (60.1, 18.6), 'Finland': (61.9, 25.7), 'Ireland': (53.4, -8.2),
+    'United Kingdom': (55.4, -3.4), 'Netherlands': (52.1, 5.3), 'Belgium': (50.5, 4.5), 'Denmark': (56.3, 9.5),
+    'Brazil': (-14.2, -51.9), 'Argentina': (-38.4, -63.6), 'Australia': (-25.3, 133.8), 'South Africa': (-30.6, 22.9)
+}
+
+# Weather readings generated and written at a time
+GENERATOR_CHUNK_ROWS = 1_000_000
+
+# Daily weather of the cities `city_ids`, spread over the countries, one row per city and day
+def weather_chunk(rng, countries, city_ids, days, date_strings):
+    n_days = len(days)
+    country_names = np.array(countries)[city_ids % len(countries)]
+    base = np.array([COUNTRY_LOCATIONS[country] for country in country_names])
+    latitude = base[:, 0] + rng.uniform(-2, 2, len(city_ids))
+    longitude = base[:, 1] + rng.uniform(-2, 2, len(city_ids))
+
+    # Seasonal temperature cycle, colder away from the equator and mirrored on the southern hemisphere
+    day_of_year = days.dayofyear.to_numpy()
+    season = np.cos(2 * np.pi * (day_of_year[None, :] - 200) / 365.25) * np.sign(latitude)[:, None]
+    tavg = 30 - 0.3 * np.abs(latitude)[:, None] + 8 * season + rng.normal(0, 2.5, (len(city_ids), n_days))
+    spread = rng.uniform(3, 8, tavg.shape)
+    rows = tavg.size
+
+    df = pd.DataFrame({
+        'country': np.repeat(country_names, n_days),
+        'city': np.repeat([f'{country} City {city}' for country, city in zip(country_names, city_ids)], n_days),
+        'date': np.tile(date_strings, len(city_ids)),
+        'tavg': tavg.ravel().round(1),
+        'tmin': (tavg - spread).ravel().round(1),
+        'tmax': (tavg + spread).ravel().round(1),
+        'wdir': rng.uniform(0, 360, rows).round(0),
+        'wspd': rng.gamma(2.0, 6.0, rows).round(1),
+        'pres': rng.normal(1013, 6, rows).round(1),
+        'Latitude': np.repeat(latitude.round(4), n_days),
+        'Longitude': np.repeat(longitude.round(4), n_days)
+    })
+
+    # Stations miss some readings
+    for column in ['tavg', 'tmin', 'tmax', 'wdir', 'wspd', 'pres']:
+        df.loc[rng.random(rows) < 0.03, column] = np.nan
+    return df
+
+# Write a synthetic daily_weather_data.csv of about `rows` rows covering `countries` and the years
+# from `start_year` to `end_year`; cities are added until the row count is reached
+def generate_weather_data(path, rows, countries, start_year, end_year, seed=0):
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(f'{start_year}-01-01', f'{end_year}-12-31')
+    date_strings = days.strftime('%d-%m-%Y').to_numpy()
+    n_cities = max(len(countries), -(-rows // len(days)))
+    cities_per_chunk = max(1, GENERATOR_CHUNK_ROWS // len(days))
+
+    for first_city in range(0, n_cities, cities_per_chunk):
+        city_ids = np.arange(first_city, min(first_city + cities_per_chunk, n_cities))
+        chunk = weather_chunk(rng, countries, city_ids, days, date_strings)
+        chunk.to_csv(path, mode='w' if first_city == 0 else 'a', header=first_city == 0, index=False)
+    return n_cities * len(days)
+
+# Write a synthetic viirs_fire_alerts__count.csv of `rows` regional weekly alert counts, with
+# most alerts in the summer weeks. With `coordinates`, every record is also located by a 'latitude'
+# and 'longitude' around its country, which the per-station join needs; the published file has none
+def generate_fire_alerts_data(path, rows, countries, start_year, end_year, seed=0, coordinates=False):
+    rng = np.random.default_rng(seed + 1)
+    iso_codes = np.array([country[:3].upper() for country in countries])
+    locations = np.array([COUNTRY_LOCATIONS[country] for country in countries])
+
+    for first_row in range(0, rows, GENERATOR_CHUNK_ROWS):
+        n = min(GENERATOR_CHUNK_ROWS, rows - first_row)
+        week = rng.integers(1, 53, n)
+        seasonal_mean = 2 + 40 * np.exp(-((week - 31) / 6.0) ** 2)
+        country_ids = rng.choice(len(countries), n)
+        chunk = pd.DataFrame({
+            'iso': iso_codes[country_ids],
+            'adm1': rng.integers(1, 14, n),
+            'adm2': rng.integers(1, 75, n),
+            'alert__year': rng.integers(start_year, end_year + 1, n),
+            'alert__week': week,
+            'confidence__cat': rng.choice(['h', 'n', 'l'], n, p=[0.2, 0.7, 0.1]),
+            'alert__count': rng.poisson(seasonal_mean) + 1
+        })
+        if coordinates:
+            chunk['latitude'] = (locations[country_ids, 0] + rng.uniform(-2, 2, n)).round(4)
+            chunk['longitude'] = (locations[country_ids, 1] + rng.uniform(-2, 2, n)).round(4)
+        chunk.to_csv(path, mode='w' if first_row == 0 else 'a', header=first_row == 0, index=False)
+    return rows
+
+# Write both synthetic raw files into `output_folder` and return their paths; `fire_alerts_coordinates`
+# locates the fire alert records (see generate_fire_alerts_data)
+def generate_dataset(output_folder, weather_rows, fire_alerts_rows, n_countries=len(COUNTRY_LOCATIONS),
+                     start_year=2000, end_year=2023, seed=0, fire_alerts_coordinates=False):
+    os.makedirs(output_folder, exist_ok=True)
+    countries = list(COUNTRY_LOCATIONS)[:n_countries]
+    weather_csv = os.path.join(output_folder, 'daily_weather_data.csv')
+    fire_alerts_csv = os.path.join(output_folder, 'viirs_fire_alerts__count.csv')
+    generate_weather_data(weather_csv, weather_rows, countries, start_year, end_year, seed)
+    generate_fire_alerts_data(fire_alerts_csv, fire_alerts_rows, countries, start_year, end_year, seed,
+                              fire_alerts_coordinates)
+    return weather_csv, fire_alerts_csv
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic weather and fire alerts CSV files.')
+    parser.add_argument('--output-dir', type=str, required=True, help='Directory to write the CSV files to.')
+    parser.add_argument('--weather-rows', type=int, default=1_000_000, help='Approximate number of daily weather rows.')
+    parser.add_argument('--fire-alerts-rows', type=int, default=100_000, help='Number of fire alert rows.')
+    parser.add_argument('--countries', type=int, default=len(COUNTRY_LOCATIONS), help='Number of countries (Greece is always first).')
+    parser.add_argument('--start-year', type=int, default=2000, help='First year of the history.')
+    parser.add_argument('--end-year', type=int, default=2023, help='Last year of the history.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--fire-alerts-coordinates', action='store_true',
+                        help='Also write the latitude and longitude of every fire alert record (for --stations).')
+    args = parser.parse_args()
+
+    weather_csv, fire_alerts_csv = generate_dataset(
+        args.output_dir, args.weather_rows, args.fire_alerts_rows, args.countries,
+        args.start_year, args.end_year, args.seed, args.fire_alerts_coordinates
+    )
+    print(f"Synthetic data written to {weather_csv} and {fire_alerts_csv}")
+
+if __name__ == "__main__":
+    main()
@@ -1,194 +1,1543 @@
 # Import necessary libraries
 import os
+import sys
+import json
+import logging
+import threading
+import cProfile
+import shutil
+import sqlite3
+import hashlib
+import time
+import zipfile
+import multiprocessing
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import argparse
-from kaggle.api.kaggle_api_extended import KaggleApi
 from io import StringIO
 import requests
+from fetch import fetch_file, kaggle_backend, mirror_backend
+from plan import scan, derive, where, isin, between, select, rename, aggregate, optimize, explain, execute, finalize
+from spatial import build_kdtree, nearest
+from validation import (validate_frame, format_report, weather_weekly_checks, fire_alerts_weekly_checks,
+                        merged_checks, station_checks)
+
+# Number of rows read at a time when streaming the raw CSV files
+DEFAULT_CHUNK_SIZE = 500_000
+
+logger = logging.getLogger('pipeline')
+
+# Kaggle datasets and the files used from them
+WEATHER_DATASET = 'balabaskar/historical-weather-data-of-all-country-capitals'
+WEATHER_FILE_NAME = 'daily_weather_data.csv'
+FIRE_ALERTS_DATASET = 'path-to-your-fire-alerts-dataset'
+FIRE_ALERTS_FILE_NAME = 'viirs_fire_alerts__count.csv'
+
+# Number of stages executed concurrently
+DEFAULT_WORKERS = 4
+
+# Bump when something other than the pipeline's own code alters the stage results (e.g. a changed
+# dependency), to invalidate cached stages
+PIPELINE_VERSION = 1
+
+# Modules whose code the stages run; a change to any of them invalidates every cached stage
+STAGE_MODULES = ['pipeline.py', 'plan.py', 'spatial.py']
+
+# Manifest recording the fingerprint and outcome of every stage in the output directory
+MANIFEST_NAME = 'pipeline_manifest.json'
+
+# Country whose weather is merged with the fire alerts
+COUNTRY = 'Greece'
+
+# Countries whose weekly weather is aggregated in one pass over the raw file (None for all)
+COUNTRIES = [COUNTRY]
+
+# (year, week) bounds of the analysed time window, both inclusive (None for the whole history)
+WEEK_WINDOW = ((2018, 41), (2022, 41))
+
+# Rows per Parquet row group; row groups outside a requested window are skipped from their statistics
+ROW_GROUP_SIZE = 65_536
+
+# Raw weather column names -> more descriptive names
+WEATHER_COLUMN_NAMES = {
+    'tavg': 'temp.avg',
+    'tmin': 'temp.min',
+    'tmax': 'temp.max',
+    'wdir': 'winddir',
+    'wspd': 'windspd',
+    'pres': 'pressure'
+}
+
+# Weekly averaged weather measurements
+WEATHER_MEASUREMENTS = list(WEATHER_COLUMN_NAMES.values())
+
+# Weekly aggregation applied by each processing stage
+WEATHER_AGGREGATION = {column: 'mean' for column in WEATHER_MEASUREMENTS}
+FIRE_ALERTS_AGGREGATION = {'alert__count': 'sum'}
+
+# The weekly weather per station also averages the station coordinates, which only vary by rounding
+STATION_WEATHER_AGGREGATION = {'latitude': 'mean', 'longitude': 'mean', **WEATHER_AGGREGATION}
+
+# Fire alerts farther than this from their nearest weather station (in km) are not joined to it
+DEFAULT_STATION_MAX_KM = 500
+
+# CSV parser used by the readers ('c' or 'pyarrow')
+DEFAULT_CSV_ENGINE = 'c'
+
+# Approximate size of one raw CSV row, used to turn a chunk size into a pyarrow block size
+APPROX_ROW_BYTES = 96
+
+# Declared schemas: only these columns are read, with these compact dtypes.
+# Raw measurements stay float64 because weekly means that land on a .x5 tie would round
+# differently from float32 inputs; the already rounded weekly values are safe as float32
+WEATHER_SCHEMA = {
+    'country': 'category',
+    'date': 'str',
+    'tavg': 'float64',
+    'tmin': 'float64',
+    'tmax': 'float64',
+    'wdir': 'float64',
+    'wspd': 'float64',
+    'pres': 'float64'
+}
+
+FIRE_ALERTS_SCHEMA = {
+    'alert__year': 'int16',
+    'alert__week': 'int8',
+    'alert__count': 'int32'
+}
+
+WEATHER_WEEKLY_SCHEMA = {
+    'year': 'int16',
+    'week': 'int8',
+    **{column: 'float32' for column in WEATHER_MEASUREMENTS}
+}
+
+FIRE_ALERTS_WEEKLY_SCHEMA = FIRE_ALERTS_SCHEMA
+
+# The spatial join reads the station of every weather reading and the location of every fire alert
+# record; the raw station coordinates are renamed like the alert coordinates
+STATION_COLUMN_NAMES = {'Latitude': 'latitude', 'Longitude': 'longitude'}
+
+STATION_WEATHER_SCHEMA = {
+    **WEATHER_SCHEMA,
+    'city': 'category',
+    'Latitude': 'float64',
+    'Longitude': 'float64'
+}
+
+LOCATED_FIRE_ALERTS_SCHEMA = {
+    **FIRE_ALERTS_SCHEMA,
+    'latitude': 'float64',
+    'longitude': 'float64'
+}
+
+STATION_WEEKLY_SCHEMA = {
+    'country': 'category',
+    'city': 'category',
+    'latitude': 'float64',
+    'longitude': 'float64',
+    **WEATHER_WEEKLY_SCHEMA,
+    'alert__count': 'int32'
+}
+
+# Names of the stage outputs, stored as Parquet intermediates and optionally exported as CSV.
+# The weekly weather is a dataset partitioned by country, exported per country
+WEATHER_WEEKLY_DATASET = 'weather_weekly_aggregated'
+FIRE_ALERTS_WEEKLY_NAME = 'processed_fire_alerts_aggregated'
+MERGED_NAME = 'merged_weather_fire_alerts'
+STATION_WEEKLY_NAME = 'station_weather_fire_alerts'
+
+# Per-(country, week) sums and counts kept by the incremental weather stage
+WEATHER_STATE_NAME = 'weather_weekly_state'
+
+# Bytes before the high-water mark of a raw file that are hashed to recognise the same file on the next run
+HIGH_WATER_TAIL_BYTES = 65_536
+
+# Largest distance of a reading times ten from a whole number that still counts as one decimal
+# (the float error of parsing a one-decimal reading)
+TENTHS_TOLERANCE = 1e-6
+
+# Key of the pipeline's JSON metadata in the schema of the Parquet files it writes
+PARQUET_METADATA_KEY = b'pipeline'
+
+# Export name of one country's weekly weather
+def weather_weekly_name(country):
+    return f"{country.lower().replace(' ', '_')}_weather_weekly_aggregated"
+
+# SQLite tables written by the SQLite sink and their primary keys
+SQLITE_TABLES = {
+    'weather_weekly': ['country', 'year', 'week'],
+    'fire_alerts_weekly': ['alert__year', 'alert__week'],
+    'merged_weekly': ['year', 'week']
+}
+
+# Pragmas for bulk loading: WAL journal, relaxed fsync, in-memory temp storage and a 64 MB page cache
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'cache_size': -65536
+}
+
+# How stage outputs are validated: 'report' logs every violation, 'fail-fast' stops at the first one
+DEFAULT_VALIDATION = 'report'
 
 # Ensure the directory exists, elsee create it
 def ensure_directory(path):
     if not os.path.exists(path):
         try:
             os.makedirs(path)
-            print(f"Directory created: {path}")
+            logger.info("Directory created: %s", path)
         except Exception as e:
-            print(f"Error creating directory {path}: {e}")
+            logger.error("Error creating directory %s: %s", path, e)
             exit(1)
     else:
-        print(f"Directory already exists: {path}")
-
-# Download a file from Kaggle
-def download_csv_from_kaggle(dataset, file_name, output_folder):
-    api = KaggleApi()
-    api.authenticate()
-    api.dataset_download_file(dataset, file_name, path=output_folder, unzip=True)
-    csv_path = os.path.join(output_folder, file_name)
+        logger.debug("Directory already exists: %s", path)
+
+# Download a file from Kaggle, or from the given fetch backend (e.g. a local mirror), unless the
+# local copy is up to date; the returned path may be a .zip archive, which the readers stream from
+def download_csv_from_kaggle(dataset, file_name, output_folder, backend=None, manifest=None):
+    checksum = None if manifest is None else (lambda path: file_hash(path, manifest))
+    csv_path, transferred = fetch_file(backend or kaggle_backend(), dataset, file_name, output_folder, checksum=checksum)
+    record_metrics(bytes_written=transferred)
+    if not transferred:
+        record_metrics(cached=1)
     return csv_path
 
-# Process weather data: filter for Greece + aggregate by week
-def process_weather_data(csv_file, output_folder):
+# Open a raw CSV for reading; a zip archive is read from its CSV member without extracting it.
+# With `byte_range` (start, end), only those bytes of a plain CSV are read, through a memory map
+def open_csv_source(csv_file, byte_range=None):
+    if byte_range is not None:
+        start, end = byte_range
+        source = pa.memory_map(csv_file)
+        source.seek(start)
+        return pa.BufferReader(source.read_buffer(end - start))
+    if not csv_file.endswith('.zip'):
+        return open(csv_file, 'rb')
+    archive = zipfile.ZipFile(csv_file)
+    members = [name for name in archive.namelist() if name.endswith('.csv')] or archive.namelist()
+    return archive.open(members[0])
+
+# Column names of the raw header, as they are spelled in the file
+def read_header(csv_file):
+    with open_csv_source(csv_file) as source:
+        return list(pd.read_csv(source, nrows=0).columns)
+
+# Map the schema onto the raw header, whose column names may carry whitespace
+def resolve_schema(csv_file, schema):
+    header = read_header(csv_file)
+    return {column: schema[column.strip()] for column in header if column.strip() in schema}
+
+# Arrow type for a declared pandas dtype
+def arrow_type(dtype):
+    if dtype == 'category':
+        return pa.dictionary(pa.int32(), pa.string())
+    if dtype == 'str':
+        return pa.string()
+    return pa.from_numpy_dtype(dtype)
+
+# Stream the declared columns with their declared dtypes in chunks of about `chunksize` rows.
+# Filters are pushed into the reader so dropped rows never leave the chunk they were parsed in:
+# `predicate` returns a mask of rows to keep, then `yearweek` keys each row (added as a 'yearweek'
+# column) and rows without a date or outside `window` are dropped.
+# `byte_range` (start, end) limits the read to whole lines between those offsets of a plain CSV
+def read_csv_chunks(csv_file, schema, chunksize=DEFAULT_CHUNK_SIZE, engine=DEFAULT_CSV_ENGINE,
+                    predicate=None, yearweek=None, window=None, byte_range=None):
+    dtypes = resolve_schema(csv_file, schema)
+    start_key, end_key = window_keys(window)
+    record_metrics(bytes_read=os.path.getsize(csv_file) if byte_range is None else byte_range[1] - byte_range[0])
+
+    if byte_range is not None and byte_range[0] >= byte_range[1]:
+        return
+
+    # A range past the header starts with data, so the column names are taken from the header
+    names = read_header(csv_file) if byte_range is not None and byte_range[0] > 0 else None
+    with open_csv_source(csv_file, byte_range) as source:
+        if engine == 'pyarrow':
+            reader = pacsv.open_csv(
+                source,
+                read_options=pacsv.ReadOptions(block_size=chunksize * APPROX_ROW_BYTES, column_names=names),
+                parse_options=pacsv.ParseOptions(invalid_row_handler=lambda row: 'skip'),
+                convert_options=pacsv.ConvertOptions(
+                    include_columns=list(dtypes),
+                    column_types={column: arrow_type(dtype) for column, dtype in dtypes.items()}
+                )
+            )
+            chunks = (batch.to_pandas() for batch in reader)
+        else:
+            chunks = pd.read_csv(source, usecols=list(dtypes), dtype=dtypes, on_bad_lines='skip', chunksize=chunksize,
+                                 **({'header': None, 'names': names} if names else {}))
+
+        for chunk in chunks:
+            record_metrics(rows_in=len(chunk))
+            chunk.columns = chunk.columns.str.strip()
+            if predicate is not None:
+                chunk = chunk[predicate(chunk)]
+            if yearweek is not None and not chunk.empty:
+                chunk = chunk.assign(yearweek=yearweek(chunk))
+                chunk = chunk[chunk['yearweek'].between(start_key, end_key)]
+            if not chunk.empty:
+                yield chunk
+
+# Metrics of the stage running in the current thread (see run_instrumented)
+_stage_metrics = threading.local()
+
+# cProfile can only profile one stage at a time
+_profile_lock = threading.Lock()
+
+# Add counts (rows_in, rows_out, bytes_read, bytes_written, ...) to the metrics of the running stage
+def record_metrics(**counts):
+    metrics = getattr(_stage_metrics, 'current', None)
+    if metrics is None:
+        return
+    for name, value in counts.items():
+        metrics[name] = metrics.get(name, 0) + value
+
+# Size of a file, or of all files below a directory
+def path_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+# Peak resident set size of the process so far, in MB
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+# Load the stage manifest of an output directory
+def load_manifest(output_folder):
+    manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {'stages': {}, 'files': {}, 'incremental': {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+# Save the stage manifest of an output directory
+def save_manifest(manifest, output_folder):
+    manifest_path = os.path.join(output_folder, MANIFEST_NAME)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+# SHA-256 of a file's content; hashes are cached in the manifest by size and mtime
+def file_hash(path, manifest):
+    stat = os.stat(path)
+    cached = manifest['files'].get(path)
+    if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+        return cached['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    manifest['files'][path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+    return digest.hexdigest()
+
+# SHA-256 of a file, or of all files below a directory with their relative paths
+def path_hash(path, manifest):
+    if not os.path.isdir(path):
+        return file_hash(path, manifest)
+
+    digest = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(path)):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode())
+            digest.update(file_hash(file_path, manifest).encode())
+    return digest.hexdigest()
+
+# SHA-256 of the source of the stage modules, computed once per process. The whole modules are
+# hashed because the stages share helpers (readers, plans, the KD-tree) that change independently
+_code_hash = {}
+
+def code_hash():
+    if 'sha256' not in _code_hash:
+        digest = hashlib.sha256()
+        for name in STAGE_MODULES:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as f:
+                digest.update(name.encode())
+                digest.update(f.read())
+        _code_hash['sha256'] = digest.hexdigest()
+    return _code_hash['sha256']
+
+# Fingerprint of a stage: its function, the code of the stage modules, its input file contents and its parameters
+def stage_fingerprint(func, input_files, params, manifest):
+    digest = hashlib.sha256()
+    digest.update(str(PIPELINE_VERSION).encode())
+    digest.update(func.__name__.encode())
+    digest.update(code_hash().encode())
+    for path in input_files:
+        digest.update(file_hash(path, manifest).encode())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+# Content hash of an in-memory DataFrame, for stages whose inputs are not files
+def dataframe_hash(df):
+    digest = hashlib.sha256(','.join(map(str, df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+# Run a stage, or reuse its stored output when its fingerprint matches the manifest
+# `run` computes the stage result, `load` rebuilds it from `output_path`
+def run_cached_stage(manifest, stage, func, input_files, params, output_path, run, load, refresh=False):
+    fingerprint = stage_fingerprint(func, input_files, params, manifest)
+    entry = manifest['stages'].get(stage)
+
+    if refresh:
+        reason = 'refresh requested'
+    elif entry is None:
+        reason = 'no cached result'
+    elif entry['fingerprint'] != fingerprint:
+        reason = 'fingerprint changed'
+    elif not os.path.exists(output_path) or path_hash(output_path, manifest) != entry['output_hash']:
+        reason = 'cached output missing or modified'
+    else:
+        reason = None
+
+    if reason is None:
+        logger.info("Skipping %s: fingerprint unchanged, reusing %s", stage, output_path)
+        record_metrics(cached=1)
+        entry.update(status='skipped', reason='fingerprint unchanged', checked_at=datetime.now(timezone.utc).isoformat())
+        return load(output_path)
+
+    logger.info("Running %s: %s", stage, reason)
+    result = run()
+    manifest['stages'][stage] = {
+        'fingerprint': fingerprint,
+        'inputs': list(input_files),
+        'params': params,
+        'output': output_path,
+        'output_hash': path_hash(output_path, manifest),
+        'status': 'ran',
+        'reason': reason,
+        'checked_at': datetime.now(timezone.utc).isoformat()
+    }
+    return result
+
+# Write a DataFrame as a Parquet file, optionally with JSON `metadata` in its schema. The file is
+# written next to `path` and moved into place, so readers never see a partial file and metadata
+# stored in it (such as a high-water mark) is replaced together with the data it describes
+def write_parquet(df, path, metadata=None):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if metadata is not None:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                               PARQUET_METADATA_KEY: json.dumps(metadata).encode()})
+    pq.write_table(table, f'{path}.tmp', row_group_size=ROW_GROUP_SIZE)
+    os.replace(f'{path}.tmp', path)
+
+# The JSON metadata stored by write_parquet; empty when the file is missing or has none
+def parquet_metadata(path):
+    if not os.path.exists(path):
+        return {}
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata[PARQUET_METADATA_KEY]) if PARQUET_METADATA_KEY in metadata else {}
+
+# Persist a stage output as a Parquet intermediate
+def write_intermediate(df, output_folder, name, metadata=None):
+    output_path = os.path.join(output_folder, f'{name}.parquet')
+    write_parquet(df, output_path, metadata)
+    record_metrics(bytes_written=path_size(output_path))
+    return output_path
+
+# Persist a stage output as a Parquet dataset with one partition per value of `partition_col`
+def write_partitioned_intermediate(df, output_folder, name, partition_col):
+    output_path = os.path.join(output_folder, name)
+    if os.path.exists(output_path):
+        shutil.rmtree(output_path)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_to_dataset(table, output_path, partition_cols=[partition_col], basename_template='part-{i}.parquet',
+                        row_group_size=ROW_GROUP_SIZE)
+    record_metrics(bytes_written=path_size(output_path))
+    return output_path
+
+# Load a Parquet intermediate through a memory map, optionally only some columns.
+# For partitioned datasets `filters` on the partition column only read the matching partitions
+def read_intermediate(path, columns=None, filters=None):
+    table = pq.read_table(path, columns=columns, filters=filters, memory_map=True)
+    record_metrics(rows_in=table.num_rows, bytes_read=table.nbytes)
+    return table.to_pandas()
+
+# Export a stage output as CSV
+def export_csv(df, output_folder, name):
+    output_csv_path = os.path.join(output_folder, f'{name}.csv')
+    df.to_csv(output_csv_path, index=False)
+    record_metrics(bytes_written=os.path.getsize(output_csv_path))
+    logger.info("Exported %s to %s", name, output_csv_path)
+    return output_csv_path
+
+# Single integer (year, week) key shared by the filters, group-bys and the merge: year * 100 + week
+def yearweek_key(year, week):
+    return np.asarray(year, dtype='int32') * 100 + np.asarray(week, dtype='int32')
+
+# Split yearweek keys back into year and week
+def split_yearweek(yearweek):
+    return yearweek // 100, yearweek % 100
+
+# Inclusive yearweek bounds of a time window; without a window every valid key is kept
+def window_keys(window):
+    if window is None:
+        return 0, np.iinfo('int32').max
+    (start_year, start_week), (end_year, end_week) = window
+    return start_year * 100 + start_week, end_year * 100 + end_week
+
+# Parquet filter expression of a time window over year and week columns, letting the reader
+# skip row groups whose year/week statistics fall outside the window
+def window_filter(window, year='year', week='week'):
+    if window is None:
+        return None
+    (start_year, start_week), (end_year, end_week) = window
+    year, week = pc.field(year), pc.field(week)
+    return (((year > start_year) | ((year == start_year) & (week >= start_week))) &
+            ((year < end_year) | ((year == end_year) & (week <= end_week))))
+
+# Parse a 'YYYY-WW' command-line value into (year, week)
+def parse_yearweek(value):
+    year, week = value.split('-')
+    return int(year), int(week)
+
+# ISO yearweek keys of date strings; missing dates get -1
+# The data is daily, so each distinct date string is parsed only once and ISO year and
+# week come from one vectorized pass: the ISO year is the year of the week's Thursday
+def iso_yearweek(date_strings, date_format='%d-%m-%Y'):
+    codes, unique_dates = pd.factorize(date_strings)
+    days = pd.to_datetime(unique_dates, format=date_format).values.astype('datetime64[D]')
+    weekday = (days.astype('int64') + 3) % 7  # Monday = 0, 1970-01-01 was a Thursday
+    thursday = days + (3 - weekday)
+    iso_year = thursday.astype('datetime64[Y]')
+    iso_week = (thursday - iso_year.astype('datetime64[D]')).astype('int64') // 7 + 1
+    keys = yearweek_key(iso_year.astype('int64') + 1970, iso_week)
+    return np.where(codes >= 0, keys[codes], -1)
+
+# Offset just past the last complete line of a file
+def last_line_end(path):
+    with open(path, 'rb') as f:
+        position = os.path.getsize(path)
+        while position > 0:
+            block_start = max(0, position - HIGH_WATER_TAIL_BYTES)
+            f.seek(block_start)
+            newline = f.read(position - block_start).rfind(b'\n')
+            if newline >= 0:
+                return block_start + newline + 1
+            position = block_start
+    return 0
+
+# SHA-256 of the bytes just before `offset`
+def tail_hash(path, offset):
+    with open(path, 'rb') as f:
+        start = max(0, offset - HIGH_WATER_TAIL_BYTES)
+        f.seek(start)
+        return hashlib.sha256(f.read(offset - start)).hexdigest()
+
+# Byte range of a raw CSV an incremental stage still has to fold into its stored state, and the
+# high-water mark it resumes from (None when the state is rebuilt). The mark is the end of the lines
+# processed so far and is stored with the state at `state_path`, so the two are always replaced together.
+# The state is rebuilt from the whole file when the stage's manifest `state` was cleared (refresh or
+# first run), the parameters changed, the stored state is missing, or the file was replaced rather
+# than appended to (shorter than the mark, or different bytes before it).
+# Zipped files cannot be read from an offset and are always read whole
+def unprocessed_range(csv_file, state, params, state_path):
+    if csv_file.endswith('.zip'):
+        return None, None
+    end = last_line_end(csv_file)
+    mark = parquet_metadata(state_path).get('high_water_mark') if state else None
+    if not (mark and mark['high_water_mark'] <= end and mark['params'] == json.loads(json.dumps(params))
+            and tail_hash(csv_file, mark['high_water_mark']) == mark['tail_hash']):
+        logger.info("Rebuilding the incremental state from the whole of %s", csv_file)
+        return (0, end), None
+    logger.info("Reading %s from its high-water mark: %d new bytes", csv_file, end - mark['high_water_mark'])
+    return (mark['high_water_mark'], end), mark
+
+# High-water mark at the end of the range an incremental stage has just processed, to be stored with
+# its state (None for zipped files, which are read whole)
+def high_water_mark(csv_file, params, byte_range):
+    if byte_range is None:
+        return None
+    return {'source': csv_file, 'params': json.loads(json.dumps(params)), 'high_water_mark': byte_range[1],
+            'tail_hash': tail_hash(csv_file, byte_range[1]), 'updated_at': datetime.now(timezone.utc).isoformat()}
+
+# Record the stored high-water mark of an incremental stage in its manifest entry, for inspection
+# and so that the next run resumes from it unless refreshed
+def record_high_water_mark(state, mark):
+    state.clear()
+    state.update(mark or {})
+
+# Store the weekly weather sums (in tenths) and counts of the incremental mode as one Parquet file, together
+# with the high-water mark they were folded up to
+def save_weather_state(weekly_sums, weekly_counts, path, mark=None):
+    write_parquet(weekly_sums.join(weekly_counts, rsuffix='__count').reset_index(), path, {'high_water_mark': mark})
+
+# Load the weekly weather sums and counts stored by save_weather_state
+def load_weather_state(path):
+    state = pd.read_parquet(path, memory_map=True).set_index(['country', 'yearweek'])
+    weekly_counts = state[[f'{column}__count' for column in WEATHER_MEASUREMENTS]]
+    return state[WEATHER_MEASUREMENTS], weekly_counts.rename(columns=lambda column: column[:-len('__count')])
+
+# Line-aligned partitions of `byte_range` of a CSV (by default all lines after the header) for
+# `processes` workers; boundaries are moved to the next line start, so no line is split or read twice.
+# Assumes quoted fields contain no line breaks, which holds for the raw weather and fire alerts files
+def partition_byte_range(csv_file, processes, byte_range=None):
+    if byte_range is None:
+        with open(csv_file, 'rb') as f:
+            f.readline()
+            byte_range = (f.tell(), last_line_end(csv_file))
+    start, end = byte_range
+    boundaries = [start]
+    with open(csv_file, 'rb') as f:
+        for i in range(1, processes):
+            f.seek(max(start + (end - start) * i // processes - 1, boundaries[-1]))
+            f.readline()
+            boundaries.append(min(max(f.tell(), boundaries[-1]), end))
+    boundaries.append(end)
+    return [(a, b) for a, b in zip(boundaries, boundaries[1:]) if b > a]
+
+# Run one partition in a worker process and return its result with the metrics it recorded
+def run_partition(aggregate, *args, **kwargs):
+    _stage_metrics.current = {}
+    try:
+        return aggregate(*args, **kwargs), _stage_metrics.current
+    finally:
+        _stage_metrics.current = None
+
+# Aggregate a CSV, or its `byte_range`, with `aggregate(csv_file, ..., byte_range=...)`: in this
+# process, or over line-aligned partitions in `processes` worker processes. Returns the partial
+# results in file order, to be combined by the caller; zipped files cannot be split and run serially
+def aggregate_csv(aggregate, csv_file, args, processes=1, byte_range=None):
+    if processes <= 1 or csv_file.endswith('.zip'):
+        return [aggregate(csv_file, *args, byte_range=byte_range)]
+
+    partitions = partition_byte_range(csv_file, processes, byte_range)
+    logger.info("Aggregating %s in %d partitions", csv_file, len(partitions))
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(run_partition, aggregate, csv_file, *args, byte_range=partition) for partition in partitions]
+        partials = []
+        for future in futures:
+            partial, metrics = future.result()
+            record_metrics(**metrics)
+            partials.append(partial)
+    return partials
+
+# Add up partial weekly sums (or counts) indexed by their key; None stands for no rows
+def combine_partials(partials):
+    combined = None
+    for partial in partials:
+        if partial is None:
+            continue
+        combined = partial if combined is None else combined.add(partial, fill_value=0)
+    return combined
+
+# Readings of a measurement in whole tenths. A reading with more decimals cannot be counted in
+# tenths without changing the weekly means, so it is rejected rather than rounded
+def tenths(values, column):
+    scaled = values * 10
+    rounded = scaled.round()
+    precise = (scaled - rounded).abs() > TENTHS_TOLERANCE
+    if precise.any():
+        raise ValueError(f"Column {column!r} has readings with more than one decimal, e.g. {values[precise].iloc[0]!r}; "
+                         f"the weekly sums are counted in exact tenths")
+    return rounded
+
+# Count the measurements of a plan in whole tenths. The raw readings have one decimal, so their
+# weekly sums become exact integers, which do not depend on the order readings, chunks, partitions
+# and incremental runs are added up in
+def in_tenths(plan, columns):
+    for column in columns:
+        plan = derive(plan, column, [column], lambda get, column=column: tenths(get(column), column),
+                      f'tenths of {column}')
+    return plan
+
+# Weekly sums of the measurements counted in tenths, back in their unit: the sum of the readings
+# rounded once to a float, as the summation of the raw values gives it up to its rounding errors
+def from_tenths(weekly_sums, columns=WEATHER_MEASUREMENTS):
+    return weekly_sums.assign(**{column: weekly_sums[column] / 10 for column in columns})
+
+# Query plan of the weekly weather: filter for the countries, key every reading by the ISO year
+# and week of its date, filter for the time window, drop the other columns, count the
+# measurements in tenths, rename + aggregate
+def weather_plan(countries=COUNTRIES, window=WEEK_WINDOW):
+    plan = scan(WEATHER_SCHEMA)
+    plan = derive(plan, 'country', ['country'], lambda get: get('country').str.strip(), 'strip country')
+    if countries is not None:
+        plan = isin(plan, 'country', countries)
+    plan = derive(plan, 'yearweek', ['date'], lambda get: iso_yearweek(get('date')), 'yearweek of date')
+    plan = between(plan, 'yearweek', *window_keys(window))
+    plan = select(plan, ['country', 'yearweek'] + list(WEATHER_COLUMN_NAMES))
+    plan = in_tenths(plan, WEATHER_COLUMN_NAMES)
+    plan = rename(plan, WEATHER_COLUMN_NAMES)
+    return aggregate(plan, ['country', 'yearweek'], WEATHER_AGGREGATION)
+
+# Query plan of the weekly fire alerts: key every alert by its year and week, filter for the
+# time window + sum 'alert__count'
+def fire_alerts_plan(window=WEEK_WINDOW):
+    plan = scan(FIRE_ALERTS_SCHEMA)
+    plan = derive(plan, 'yearweek', ['alert__year', 'alert__week'],
+                  lambda get: yearweek_key(get('alert__year'), get('alert__week')), 'yearweek of alert__year, alert__week')
+    plan = between(plan, 'yearweek', *window_keys(window))
+    return aggregate(plan, ['yearweek'], FIRE_ALERTS_AGGREGATION)
+
+# Run a plan over a raw CSV, or its `byte_range`; the optimised plan decides which columns are
+# parsed and which rows the reader drops while parsing
+def execute_csv(plan, csv_file, chunksize, engine, byte_range=None):
+    return execute(plan, lambda schema, predicate: read_csv_chunks(
+        csv_file, schema, chunksize=chunksize, engine=engine, predicate=predicate, byte_range=byte_range))
+
+# Weekly sums (in tenths) and non-null counts of the weather measurements per (country, yearweek),
+# of the whole CSV or of its `byte_range`; (None, None) when no reading is kept
+def aggregate_weather(csv_file, countries, window, chunksize, engine, byte_range=None):
+    weekly_sums, weekly_counts, _ = execute_csv(weather_plan(countries, window), csv_file, chunksize, engine, byte_range)
+    return weekly_sums, weekly_counts
+
+# Process weather data: filter for the countries + aggregate by country and week
+# The CSV is streamed in chunks of `chunksize` rows; each chunk is filtered and folded
+# into running per-(country, year, week) sums and counts, so memory depends on the chunk size only.
+# All countries are aggregated in one pass when `countries` is None.
+# With `processes` > 1, line-aligned parts of the file are aggregated in that many worker processes
+# and their sums and counts are added up; the means are the same as with one process.
+# With an incremental `state` (the stage's entry in the manifest), the sums and counts are kept
+# in weather_weekly_state.parquet and each run only folds in the lines appended since the last one;
+# the weeks those lines touched are listed in the result's attrs['updated_yearweeks'] and the
+# high-water mark the run resumed from in attrs['resumed_from'] (both None after a rebuild)
+def process_weather_data(csv_file, output_folder, countries=COUNTRIES, window=WEEK_WINDOW,
+                         chunksize=DEFAULT_CHUNK_SIZE, engine=DEFAULT_CSV_ENGINE, state=None, processes=1):
     ensure_directory(output_folder)
-    df = pd.read_csv(csv_file, on_bad_lines='skip')
-    print("Columns in the CSV file:", df.columns)
-
-    # Whitespace from column names
-    df.columns = df.columns.str.strip()
-    print("Columns after stripping whitespace:", df.columns)
-
-    if 'country' in df.columns:
-        print("Filtering for Greece...")
-        df_greece = df[df['country'].str.strip() == 'Greece']
-        print("Filtered DataFrame head:", df_greece.head())
-
-        # Convert date column to datetime format
-        df_greece['date'] = pd.to_datetime(df_greece['date'], format='%d-%m-%Y')
-
-        # Extract week number and year
-        df_greece['week'] = df_greece['date'].dt.isocalendar().week
-        df_greece['year'] = df_greece['date'].dt.isocalendar().year
-
-        # Filter for data starting from week 41 of 2018 until week 41 of 2022
-        df_greece = df_greece[
-            ((df_greece['year'] > 2018) | ((df_greece['year'] == 2018) & (df_greece['week'] >= 41))) &
-            ((df_greece['year'] < 2022) | ((df_greece['year'] == 2022) & (df_greece['week'] <= 41)))
-        ]
-
-        # Drop unnecessary columns
-        df_greece.drop(columns=['date', 'country', 'Latitude', 'Longitude'], inplace=True)
-
-        # Rename columns to more descriptive names
-        df_greece.rename(columns={
-            'tavg': 'temp.avg',
-            'tmin': 'temp.min',
-            'tmax': 'temp.max',
-            'wdir': 'winddir',
-            'wspd': 'windspd',
-            'pres': 'pressure'
-        }, inplace=True)
-
-        # Group by 'year' and 'week' + calculate the avg. temp. and sum other columns
-        df_grouped = df_greece.groupby(['year', 'week'], as_index=False).agg({
-            'temp.avg': 'mean',
-            'temp.min': 'mean',
-            'temp.max': 'mean',
-            'winddir': 'mean',
-            'windspd': 'mean',
-            'pressure': 'mean'
-        })
 
-        # Round the aggregated values to one decimal place
-        df_grouped = df_grouped.round(1)
+    if 'country' not in [column.strip() for column in resolve_schema(csv_file, WEATHER_SCHEMA)]:
+        raise ValueError(f"{csv_file} does not contain the 'country' column")
+
+    plan = weather_plan(countries, window)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Weather plan:\n%s", '\n'.join(explain(optimize(plan))))
 
-        # Save the DataFrame to a new CSV file
-        output_csv_path = os.path.join(output_folder, 'greece_weather_weekly_aggregated.csv')
-        df_grouped.to_csv(output_csv_path, index=False)
-        print(f"All observations for Greece with weeks saved to {output_csv_path}")
+    byte_range, resumed_from = None, None
+    if state is not None:
+        # The unit of the stored sums is part of the parameters, so a state of another unit is rebuilt
+        params = {'countries': countries, 'window': window, 'sums': 'tenths'}
+        state_path = os.path.join(output_folder, f'{WEATHER_STATE_NAME}.parquet')
+        byte_range, resumed_from = unprocessed_range(csv_file, state, params, state_path)
+
+    partials = aggregate_csv(aggregate_weather, csv_file, (countries, window, chunksize, engine), processes, byte_range)
+    weekly_sums = combine_partials(sums for sums, _ in partials)
+    weekly_counts = combine_partials(counts for _, counts in partials)
+    updated_yearweeks = [] if weekly_sums is None else weekly_sums.index.get_level_values('yearweek').unique().tolist()
+    if resumed_from is not None:
+        previous_sums, previous_counts = load_weather_state(state_path)
+        weekly_sums = combine_partials([previous_sums, weekly_sums])
+        weekly_counts = combine_partials([previous_counts, weekly_counts])
+
+    if weekly_sums is None:
+        df_grouped = pd.DataFrame(columns=['country', 'year', 'week'] + WEATHER_MEASUREMENTS)
     else:
-        print("The CSV file does not contain the 'country' column.")
-        return
+        # Weekly means from the accumulated state (weeks without any reading stay NaN)
+        weekly_means = finalize(plan, from_tenths(weekly_sums), weekly_counts).sort_index()
+        year, week = split_yearweek(weekly_means.index.get_level_values('yearweek').to_numpy())
+        df_grouped = weekly_means.reset_index(level='yearweek', drop=True).reset_index()
+        df_grouped.insert(1, 'year', year)
+        df_grouped.insert(2, 'week', week)
+
+    # Round the aggregated values to one decimal place. The means come from exact sums, so they do not
+    # depend on chunks, partitions or incremental runs; a mean exactly halfway between two tenths
+    # rounds like its float, which a plain float summation of the readings may put on either side
+    df_grouped = df_grouped.round(1).astype({**WEATHER_WEEKLY_SCHEMA, 'country': 'category'})
+
+    # Save the DataFrame as a dataset partitioned by country and hand it to the next stage
+    output_path = write_partitioned_intermediate(df_grouped, output_folder, WEATHER_WEEKLY_DATASET, 'country')
+    logger.info("Weekly weather of %d countries saved to %s", df_grouped['country'].nunique(), output_path)
+    # The state is saved after the output it was computed from: a run stopped in between resumes
+    # from the previous state and mark and writes the same output again
+    if state is not None:
+        mark = None if weekly_sums is None else high_water_mark(csv_file, params, byte_range)
+        if weekly_sums is None:
+            if os.path.exists(state_path):
+                os.remove(state_path)
+        else:
+            save_weather_state(weekly_sums, weekly_counts, state_path, mark)
+        record_high_water_mark(state, mark)
+        df_grouped.attrs['updated_yearweeks'] = sorted(updated_yearweeks) if resumed_from is not None else None
+        df_grouped.attrs['resumed_from'] = resumed_from
+    return df_grouped
+
+# Weekly alert sums per yearweek of the whole CSV or of its `byte_range`, and the number of alerts kept
+def aggregate_fire_alerts(csv_file, window, chunksize, engine, byte_range=None):
+    weekly_sums, _, rows = execute_csv(fire_alerts_plan(window), csv_file, chunksize, engine, byte_range)
+    return weekly_sums, rows
 
 # Process fire alerts data: filter + aggregate by week
-def process_fire_alerts_data(csv_file, output_folder):
+# With `processes` > 1, line-aligned parts of the file are aggregated in that many worker processes.
+# The weekly sums are their own mergeable state: with an incremental `state` (the stage's entry in
+# the manifest) only the lines appended since the last run are read and added to the previous output,
+# which stores the high-water mark they were read up to; the weeks they touched are listed in the
+# result's attrs['updated_yearweeks'] and the mark the run resumed from in attrs['resumed_from']
+# (both None after a rebuild)
+def process_fire_alerts_data(csv_file, output_folder, window=WEEK_WINDOW,
+                             chunksize=DEFAULT_CHUNK_SIZE, engine=DEFAULT_CSV_ENGINE, state=None, processes=1):
     ensure_directory(output_folder)
-    df = pd.read_csv(csv_file, on_bad_lines='skip')
-    print("Columns in the CSV file:", df.columns)
-
-    # Strip whitespace from column names
-    df.columns = df.columns.str.strip()
-    print("Columns after stripping whitespace:", df.columns)
-
-    # Drop the 'iso' and 'confidence__cat' columns
-    columns_to_drop = ['iso', 'confidence__cat']
-    df.drop(columns=[col for col in columns_to_drop if col in df.columns], inplace=True)
-
-    # Filter the DataFrame again starting from week 41 of 2018 until week 41 of 2022
-    df = df[
-        ((df['alert__year'] > 2018) | ((df['alert__year'] == 2018) & (df['alert__week'] >= 41))) &
-        ((df['alert__year'] < 2022) | ((df['alert__year'] == 2022) & (df['alert__week'] <= 41)))
-    ]
-    print(f"Filtered DataFrame length: {len(df)}")
-    print("Filtered DataFrame head:", df.head())
-
-    # Group by 'alert__year' and 'alert__week' + sum 'alert__count'
-    df_grouped = df.groupby(['alert__year', 'alert__week'], as_index=False).agg({
-        'alert__count': 'sum'
-    })
-    print("Grouped DataFrame head:", df_grouped.head())
-
-    # Save the grouped DataFrame to a new CSV file
-    output_csv_path = os.path.join(output_folder, 'processed_fire_alerts_aggregated.csv')
-    df_grouped.to_csv(output_csv_path, index=False)
-    print(f"Processed fire alerts saved to {output_csv_path}")
-
-# Merge the processed weather and fire alerts datasets
-def merge_datasets(weather_csv, fire_alerts_csv, output_folder):
+    output_path = os.path.join(output_folder, f'{FIRE_ALERTS_WEEKLY_NAME}.parquet')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Fire alerts plan:\n%s", '\n'.join(explain(optimize(fire_alerts_plan(window)))))
+
+    byte_range, resumed_from = None, None
+    if state is not None:
+        params = {'window': window}
+        byte_range, resumed_from = unprocessed_range(csv_file, state, params, output_path)
+
+    partials = aggregate_csv(aggregate_fire_alerts, csv_file, (window, chunksize, engine), processes, byte_range)
+    df_grouped = combine_partials(sums for sums, _ in partials)
+    logger.info("Filtered DataFrame length: %d", sum(rows for _, rows in partials))
+    if df_grouped is None:
+        df_grouped = pd.DataFrame({'alert__count': pd.Series(dtype=FIRE_ALERTS_SCHEMA['alert__count'])},
+                                  index=pd.Index([], dtype='int32', name='yearweek'))
+
+    updated_yearweeks = df_grouped.index.tolist()
+    if resumed_from is not None:
+        previous = keyed_by_yearweek(read_intermediate(output_path), 'alert__year', 'alert__week').set_index('yearweek')
+        df_grouped = previous.add(df_grouped, fill_value=0)
+    df_grouped = df_grouped.sort_index()
+    alert_year, alert_week = split_yearweek(df_grouped.index.to_numpy())
+    df_grouped = df_grouped.reset_index(drop=True)
+    df_grouped.insert(0, 'alert__year', alert_year)
+    df_grouped.insert(1, 'alert__week', alert_week)
+    df_grouped = df_grouped.astype(FIRE_ALERTS_WEEKLY_SCHEMA)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Grouped DataFrame head:\n%s", df_grouped.head())
+
+    # Save the grouped DataFrame as an intermediate, with the high-water mark of its sums in incremental
+    # mode, and hand it to the next stage
+    mark = None if state is None else high_water_mark(csv_file, params, byte_range)
+    output_path = write_intermediate(df_grouped, output_folder, FIRE_ALERTS_WEEKLY_NAME,
+                                     None if state is None else {'high_water_mark': mark})
+    if state is not None:
+        record_high_water_mark(state, mark)
+        df_grouped.attrs['updated_yearweeks'] = sorted(updated_yearweeks) if resumed_from is not None else None
+        df_grouped.attrs['resumed_from'] = resumed_from
+    logger.info("Processed fire alerts saved to %s", output_path)
+    return df_grouped
+
+# Query plan of the weekly weather per station: like the weather plan, but grouped by the station
+# (country and city) and week, averaging the station coordinates as well
+def station_weather_plan(countries=COUNTRIES, window=WEEK_WINDOW):
+    plan = scan(STATION_WEATHER_SCHEMA)
+    plan = derive(plan, 'country', ['country'], lambda get: get('country').str.strip(), 'strip country')
+    plan = derive(plan, 'city', ['city'], lambda get: get('city').str.strip(), 'strip city')
+    if countries is not None:
+        plan = isin(plan, 'country', countries)
+    plan = derive(plan, 'yearweek', ['date'], lambda get: iso_yearweek(get('date')), 'yearweek of date')
+    plan = between(plan, 'yearweek', *window_keys(window))
+    plan = select(plan, ['country', 'city', 'yearweek'] + list(STATION_COLUMN_NAMES) + list(WEATHER_COLUMN_NAMES))
+    plan = in_tenths(plan, WEATHER_COLUMN_NAMES)
+    plan = rename(plan, {**STATION_COLUMN_NAMES, **WEATHER_COLUMN_NAMES})
+    return aggregate(plan, ['country', 'city', 'yearweek'], STATION_WEATHER_AGGREGATION)
+
+# Nearest station of every alert location (its position in the station table the KD-tree was built
+# from), or -1 when that station is not one of the `selected` stations or lies farther than `max_km`
+def assign_stations(tree, selected, max_km, latitude, longitude):
+    station, km = nearest(tree, latitude, longitude)
+    station, km = station[:, 0], km[:, 0]
+    keep = selected[station]
+    if max_km is not None:
+        keep &= km <= max_km
+    return np.where(keep, station, -1)
+
+# Query plan of the weekly fire alerts per station: key every located alert record by its year and
+# week, filter for the time window, assign it to its nearest station in the KD-tree, keep the records
+# assigned to a selected station (see assign_stations) + sum 'alert__count' per station and week
+def station_fire_alerts_plan(tree, selected, max_km=DEFAULT_STATION_MAX_KM, window=WEEK_WINDOW):
+    plan = scan(LOCATED_FIRE_ALERTS_SCHEMA)
+    plan = where(plan, ['latitude', 'longitude'], lambda get: get('latitude').notna() & get('longitude').notna(),
+                 'located')
+    plan = derive(plan, 'yearweek', ['alert__year', 'alert__week'],
+                  lambda get: yearweek_key(get('alert__year'), get('alert__week')), 'yearweek of alert__year, alert__week')
+    plan = between(plan, 'yearweek', *window_keys(window))
+    plan = derive(plan, 'station', ['latitude', 'longitude'],
+                  lambda get: assign_stations(tree, selected, max_km, get('latitude'), get('longitude')),
+                  f'nearest station within {max_km} km')
+    plan = where(plan, ['station'], lambda get: get('station') >= 0, 'selected station')
+    return aggregate(plan, ['station', 'yearweek'], FIRE_ALERTS_AGGREGATION)
+
+# Weekly sums (measurements in tenths) and non-null counts of the weather measurements and coordinates per
+# (country, city, yearweek), of the whole CSV or of its `byte_range`
+def aggregate_station_weather(csv_file, countries, window, chunksize, engine, byte_range=None):
+    weekly_sums, weekly_counts, _ = execute_csv(station_weather_plan(countries, window), csv_file, chunksize, engine,
+                                                byte_range)
+    return weekly_sums, weekly_counts
+
+# Weekly alert sums per (station, yearweek) of the whole CSV or of its `byte_range`, and the number
+# of alert records kept; `stations` are the station latitudes, longitudes and selection flags,
+# indexed in each process
+def aggregate_station_fire_alerts(csv_file, stations, max_km, window, chunksize, engine, byte_range=None):
+    latitude, longitude, selected = stations
+    plan = station_fire_alerts_plan(build_kdtree(latitude, longitude), selected, max_km, window)
+    weekly_sums, _, rows = execute_csv(plan, csv_file, chunksize, engine, byte_range)
+    return weekly_sums, rows
+
+# Why the raw files cannot be joined by location (the columns they lack), or None when they can:
+# the weather has to locate its rows by 'city', 'Latitude' and 'Longitude', the fire alerts by
+# 'latitude' and 'longitude'
+def location_columns_error(weather_csv, fire_alerts_csv):
+    errors = []
+    for csv_file, schema in [(weather_csv, STATION_WEATHER_SCHEMA), (fire_alerts_csv, LOCATED_FIRE_ALERTS_SCHEMA)]:
+        missing = set(schema) - {column.strip() for column in resolve_schema(csv_file, schema)}
+        if missing:
+            errors.append(f"{csv_file} lacks the columns {sorted(missing)} needed to join by location")
+    return '; '.join(errors) or None
+
+# Join the fire alerts to their nearest weather station: aggregate the weather per station and week
+# (keeping the station coordinates), build a KD-tree over the stations, assign every located alert
+# record to its nearest station in bulk while streaming the alerts and sum the alerts per station
+# and week. Both files are aggregated in `processes` worker processes like the other stages.
+# The tree holds the stations of every country in the weather file, so an alert is only counted for
+# a station of the selected `countries` when no station of another country lies closer; alerts
+# farther than `max_km` from their nearest station (e.g. in a country without stations) are dropped.
+# The result has one row per (country, city, year, week) of the selected countries with weather
+# readings or alerts; weeks without readings have no weather values and weeks without alerts a count of 0.
+# The raw files must locate their rows (see location_columns_error)
+def join_stations(weather_csv, fire_alerts_csv, output_folder, countries=COUNTRIES, window=WEEK_WINDOW,
+                  chunksize=DEFAULT_CHUNK_SIZE, engine=DEFAULT_CSV_ENGINE, processes=1, max_km=DEFAULT_STATION_MAX_KM):
     ensure_directory(output_folder)
+    error = location_columns_error(weather_csv, fire_alerts_csv)
+    if error is not None:
+        raise ValueError(error)
+
+    plan = station_weather_plan(None, window)
+    partials = aggregate_csv(aggregate_station_weather, weather_csv, (None, window, chunksize, engine), processes)
+    weekly_sums = combine_partials(sums for sums, _ in partials)
+    weekly_counts = combine_partials(counts for _, counts in partials)
+    if weekly_sums is not None:
+        weekly_means = finalize(plan, from_tenths(weekly_sums), weekly_counts).sort_index()
+
+        # One entry per station of any country, in the order of the KD-tree positions
+        stations = weekly_means[list(STATION_COLUMN_NAMES.values())].round(6).groupby(level=['country', 'city']).first()
+        selected = np.ones(len(stations), dtype=bool) if countries is None else \
+            stations.index.get_level_values('country').isin(countries)
+    if weekly_sums is None or not selected.any():
+        logger.warning("No station readings to join the fire alerts to")
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in STATION_WEEKLY_SCHEMA.items()})
+
+    logger.info("Joining fire alerts to the nearest of %d stations, %d of them selected", len(stations), selected.sum())
+    partials = aggregate_csv(aggregate_station_fire_alerts, fire_alerts_csv,
+                             ((stations['latitude'].to_numpy(), stations['longitude'].to_numpy(), selected), max_km,
+                              window, chunksize, engine), processes)
+    weekly_alerts = combine_partials(sums for sums, _ in partials)
+    logger.info("Fire alert records assigned to a selected station: %d", sum(rows for _, rows in partials))
+
+    weather = weekly_means[weekly_means.index.droplevel('yearweek').isin(stations.index[selected])]
+    weather = weather.drop(columns=list(STATION_COLUMN_NAMES.values()))
+    if weekly_alerts is None:
+        df_joined = weather.assign(alert__count=0)
+    else:
+        station = weekly_alerts.index.get_level_values('station')
+        weekly_alerts.index = pd.MultiIndex.from_arrays(
+            [stations.index.get_level_values('country')[station], stations.index.get_level_values('city')[station],
+             weekly_alerts.index.get_level_values('yearweek')], names=['country', 'city', 'yearweek'])
+        df_joined = pd.concat([weather, weekly_alerts], axis=1).sort_index()
+        df_joined['alert__count'] = df_joined['alert__count'].fillna(0)
+
+    stations = stations[selected]
+    year, week = split_yearweek(df_joined.index.get_level_values('yearweek').to_numpy())
+    df_joined = df_joined.reset_index(level='yearweek', drop=True).join(stations).reset_index()
+    df_joined = df_joined.assign(year=year, week=week)[list(STATION_WEEKLY_SCHEMA)]
+    df_joined[WEATHER_MEASUREMENTS] = df_joined[WEATHER_MEASUREMENTS].round(1)
+    df_joined = df_joined.astype(STATION_WEEKLY_SCHEMA)
+
+    output_path = write_intermediate(df_joined, output_folder, STATION_WEEKLY_NAME)
+    logger.info("Weekly weather and fire alerts of %d stations saved to %s", len(stations), output_path)
+    return df_joined
+
+# Load a weekly stage output from its Parquet intermediate or an exported CSV, optionally only
+# the weeks in `window`; the first two schema columns are the year and week
+def load_weekly(path, schema, engine=DEFAULT_CSV_ENGINE, window=None):
+    year, week = list(schema)[:2]
+    if path.endswith('.parquet'):
+        return read_intermediate(path, filters=window_filter(window, year, week)).astype(schema)
+    chunks = list(read_csv_chunks(path, schema, engine=engine, window=window,
+                                  yearweek=lambda chunk: yearweek_key(chunk[year], chunk[week])))
+    if not chunks:
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in schema.items()})
+    return pd.concat(chunks, ignore_index=True).drop(columns=['yearweek'])
+
+# Weekly weather of one country, from the multi-country DataFrame or by reading only that
+# country's partition of the dataset on disk, optionally only the weeks in `window` (on disk,
+# row groups outside the window are skipped). Single-country data without a 'country' column is
+# returned as is, apart from the window
+def select_country(weather, country, window=None):
+    if isinstance(weather, str):
+        filters = pc.field('country') == country
+        if window is not None:
+            filters = filters & window_filter(window)
+        weather = read_intermediate(weather, filters=filters)
+    else:
+        if window is not None:
+            start_key, end_key = window_keys(window)
+            weather = weather[pd.Series(yearweek_key(weather['year'], weather['week']), index=weather.index)
+                              .between(start_key, end_key)]
+        if 'country' not in weather.columns:
+            return weather.reset_index(drop=True)
+        weather = weather[weather['country'] == country]
+    return weather.drop(columns=['country']).reset_index(drop=True).astype(WEATHER_WEEKLY_SCHEMA)
+
+# Replace the year and week columns of a weekly DataFrame by its yearweek key
+def keyed_by_yearweek(df, year='year', week='week'):
+    keyed = df.drop(columns=[year, week])
+    keyed.insert(0, 'yearweek', yearweek_key(df[year], df[week]))
+    return keyed
+
+# Stream a Parquet intermediate as DataFrames of at most `batch_size` rows; an empty intermediate
+# yields one empty DataFrame, which still carries its columns
+def iter_intermediate(path, batch_size=ROW_GROUP_SIZE):
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    if not parquet_file.metadata.num_rows:
+        yield parquet_file.schema_arrow.empty_table().to_pandas()
+        return
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        yield batch.to_pandas()
+
+# Streaming merge join of weekly sources that are sorted by a unique integer key, as the weekly
+# group-bys produce them. Each source is a DataFrame or an iterable of DataFrame chunks; only
+# one chunk per source is held at a time. `how` is 'inner', 'left' (on the first source) or 'outer'.
+# Yields the joined rows chunk by chunk, in key order, or one empty chunk with all the columns when
+# no row is joined. A chunk iterable has to yield at least one (possibly empty) chunk, which
+# declares its columns
+def merge_sorted(sources, how='inner', key='yearweek'):
+    if how not in ('inner', 'left', 'outer'):
+        raise ValueError(f"Unsupported merge type: {how}")
+
+    iterators = [iter([source]) if isinstance(source, pd.DataFrame) else iter(source) for source in sources]
+    buffers = [None] * len(iterators)
+    templates = [pd.DataFrame(columns=[key])] * len(iterators)
+    exhausted = [False] * len(iterators)
+    joined_any = False
+
+    while True:
+        # Refill the buffers of the sources that have no rows left
+        for i, iterator in enumerate(iterators):
+            while not exhausted[i] and (buffers[i] is None or buffers[i].empty):
+                chunk = next(iterator, None)
+                if chunk is None and buffers[i] is None:
+                    raise ValueError(f"Merge source {i} yielded no chunk to take its columns from")
+                if chunk is None:
+                    exhausted[i] = True
+                else:
+                    buffers[i] = chunk
+                    templates[i] = chunk.iloc[:0]
+
+        pending = [buffer is not None and not buffer.empty for buffer in buffers]
+        if not any(pending) or (how == 'inner' and not all(pending)) or (how == 'left' and not pending[0]):
+            break
+
+        # Keys up to the smallest last key of the sources that may still deliver rows are complete
+        last_keys = [buffers[i][key].iloc[-1] for i in range(len(buffers)) if not exhausted[i]]
+        frontier = min(last_keys) if last_keys else None
+
+        heads = []
+        for i, buffer in enumerate(buffers):
+            if not pending[i]:
+                heads.append(templates[i])
+                continue
+            if not buffer[key].is_monotonic_increasing:
+                raise ValueError(f"Merge source {i} is not sorted by {key}")
+            cut = len(buffer) if frontier is None else np.searchsorted(buffer[key].to_numpy(), frontier, side='right')
+            heads.append(buffer.iloc[:cut])
+            buffers[i] = buffer.iloc[cut:]
+
+        # Join the heads on their keys
+        head_keys = [head[key].to_numpy() for head in heads]
+        if how == 'inner':
+            keys = head_keys[0]
+            for other in head_keys[1:]:
+                keys = np.intersect1d(keys, other, assume_unique=True)
+        elif how == 'left':
+            keys = head_keys[0]
+        else:
+            keys = head_keys[0]
+            for other in head_keys[1:]:
+                keys = np.union1d(keys, other)
+
+        if len(keys):
+            joined = pd.concat([head.set_index(key).reindex(keys) for head in heads], axis=1)
+            joined.index.name = key
+            joined_any = True
+            yield joined.reset_index()
+
+    if not joined_any:
+        yield pd.concat([template.set_index(key) for template in templates], axis=1).rename_axis(key).reset_index()
+
+# Merge the processed weather and fire alerts datasets, plus any further weekly sources
+# Both inputs are the DataFrames returned by the processing stages (see load_weekly to read them back);
+# the weather may also be the path of the partitioned weekly dataset. `extra_sources` are DataFrames
+# or chunk iterables keyed by 'yearweek' and sorted by it (see keyed_by_yearweek).
+# Given the `previous` merged output and the `yearweeks` that changed since, only those weeks of
+# the weather and fire alerts are merged and they replace their rows of the previous output.
+# `window` limits the weather and fire alerts to those weeks; read from the dataset on disk,
+# the weather row groups outside it are skipped. `metadata` is stored with the merged output
+def merge_datasets(weather_df, fire_alerts_df, output_folder, country=COUNTRY, how='inner', extra_sources=(),
+                   previous=None, yearweeks=None, window=None, metadata=None):
+    ensure_directory(output_folder)
+    weather_df = select_country(weather_df, country, window)
+    if previous is None and weather_df.empty:
+        logger.warning("No weekly weather of %s to merge the fire alerts with", country)
+    if window is not None:
+        start_key, end_key = window_keys(window)
+        fire_alerts_df = fire_alerts_df[pd.Series(yearweek_key(fire_alerts_df['alert__year'], fire_alerts_df['alert__week']),
+                                                  index=fire_alerts_df.index).between(start_key, end_key)]
+    record_metrics(rows_in=len(weather_df) + len(fire_alerts_df))
     
-    # Read the CSV files into pandas DataFrames
-    weather_df = pd.read_csv(weather_csv)
-    fire_alerts_df = pd.read_csv(fire_alerts_csv)
-    
-    print("Weather DataFrame columns:", weather_df.columns)
-    print("Fire Alerts DataFrame columns:", fire_alerts_df.columns)
-    
-    print("Weather DataFrame dtypes:\n", weather_df.dtypes)
-    print("Fire Alerts DataFrame dtypes:\n", fire_alerts_df.dtypes)
-    
-    # Ensure the 'year' and 'week' columns are ints
-    weather_df['year'] = weather_df['year'].astype(int)
-    weather_df['week'] = weather_df['week'].astype(int)
-    fire_alerts_df['alert__year'] = fire_alerts_df['alert__year'].astype(int)
-    fire_alerts_df['alert__week'] = fire_alerts_df['alert__week'].astype(int)
-    
-    print("Unique years in weather data:", weather_df['year'].unique())
-    print("Unique weeks in weather data:", weather_df['week'].unique())
-    print("Unique years in fire alerts data:", fire_alerts_df['alert__year'].unique())
-    print("Unique weeks in fire alerts data:", fire_alerts_df['alert__week'].unique())
-    
-    # Merge the DataFrames on the 'year' and 'week' columns
-    merged_df = pd.merge(weather_df, fire_alerts_df, left_on=['year', 'week'], right_on=['alert__year', 'alert__week'], how='inner')
-    merged_df.drop(columns=['alert__year', 'alert__week'], inplace=True)
+    # Merge the DataFrames on the single yearweek key built from 'year' and 'week'
+    sources = [keyed_by_yearweek(weather_df), keyed_by_yearweek(fire_alerts_df, 'alert__year', 'alert__week')]
+    if yearweeks is not None:
+        sources = [source[source['yearweek'].isin(yearweeks)] for source in sources]
+    merged_df = pd.concat(list(merge_sorted(sources + list(extra_sources), how=how)), ignore_index=True)
+
+    # Split the key back into 'year' and 'week'
+    year, week = split_yearweek(merged_df.pop('yearweek').to_numpy())
+    merged_df.insert(0, 'year', year)
+    merged_df.insert(1, 'week', week)
+    merged_df = merged_df.astype({'year': WEATHER_WEEKLY_SCHEMA['year'], 'week': WEATHER_WEEKLY_SCHEMA['week']})
+    if previous is not None:
+        kept = previous[~np.isin(yearweek_key(previous['year'], previous['week']), yearweeks)]
+        merged_df = pd.concat([kept, merged_df], ignore_index=True).sort_values(['year', 'week'], ignore_index=True)
+        logger.info("Updated %d weeks of the previous merged data", len(yearweeks))
     
-    # Save the merged DataFrame to a new CSV file
-    output_csv_path = os.path.join(output_folder, 'merged_weather_fire_alerts.csv')
-    merged_df.to_csv(output_csv_path, index=False)
-    print(f"Merged data saved to {output_csv_path}")
-    print(f"Merged DataFrame length: {len(merged_df)}")
-    print("Merged DataFrame head:", merged_df.head())
+    # Save the merged DataFrame as an intermediate
+    output_path = write_intermediate(merged_df, output_folder, MERGED_NAME, metadata)
+    logger.info("Merged data saved to %s", output_path)
+    logger.info("Merged DataFrame length: %d", len(merged_df))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Merged DataFrame head:\n%s", merged_df.head())
+    return merged_df
 
-def main():
-    # Define the Kaggle datasets
-    weather_dataset = 'balabaskar/historical-weather-data-of-all-country-capitals'
-    weather_file_name = 'daily_weather_data.csv'
-    fire_alerts_dataset = 'path-to-your-fire-alerts-dataset'
-    fire_alerts_file_name = 'viirs_fire_alerts__count.csv'
+# Open a SQLite database tuned for bulk loading
+def connect_sqlite(db_path):
+    conn = sqlite3.connect(db_path)
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
+
+# SQLite column type of a pandas dtype
+def sqlite_type(dtype):
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    return 'TEXT'
+
+# Rows of a DataFrame as Python values SQLite can bind; float32 values go through their
+# shortest representation so 18.3 is stored as 18.3 rather than 18.299999237060547
+def sqlite_rows(df):
+    columns = []
+    for column in df.columns:
+        values = df[column]
+        if values.dtype == 'float32':
+            values = values.astype(str).astype('float64')
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(str)
+        columns.append(values.astype(object).where(values.notna(), None))
+    return zip(*columns)
+
+# Upsert a DataFrame into a table keyed by `key_columns`, in one transaction, and delete the rows
+# whose key is no longer in the DataFrame (weeks dropped by a rerun), so the table mirrors it.
+# The table is created WITHOUT ROWID so rows are clustered on the key, which serves
+# point and range lookups by week; existing rows are only rewritten when a value changed.
+# Returns the number of rows inserted or updated and the number deleted
+def upsert_sqlite(conn, df, table, key_columns):
+    quoted = {column: f'"{column}"' for column in df.columns}
+    value_columns = [column for column in df.columns if column not in key_columns]
+
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {table} ("
+        + ", ".join(f"{quoted[column]} {sqlite_type(df[column].dtype)}" for column in df.columns)
+        + f", PRIMARY KEY ({', '.join(quoted[column] for column in key_columns)})) WITHOUT ROWID"
+    )
+    if 'year' in df.columns and 'week' in df.columns and key_columns[:2] != ['year', 'week']:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_year_week ON {table} ("year", "week")')
+
+    statement = (
+        f"INSERT INTO {table} ({', '.join(quoted.values())}) VALUES ({', '.join('?' for _ in df.columns)})"
+        f" ON CONFLICT ({', '.join(quoted[column] for column in key_columns)}) DO UPDATE SET "
+        + ", ".join(f"{quoted[column]} = excluded.{quoted[column]}" for column in value_columns)
+        + " WHERE " + " OR ".join(f"{quoted[column]} IS NOT excluded.{quoted[column]}" for column in value_columns)
+    )
+    keys = ", ".join(quoted[column] for column in key_columns)
+    stale = (
+        f"DELETE FROM {table} WHERE NOT EXISTS (SELECT 1 FROM temp.incoming_keys WHERE "
+        + " AND ".join(f"incoming_keys.{quoted[column]} = {table}.{quoted[column]}" for column in key_columns) + ")"
+    )
+    with conn:
+        changes_before = conn.total_changes
+        conn.executemany(statement, sqlite_rows(df))
+        upserted = conn.total_changes - changes_before
+        conn.execute(f"CREATE TEMP TABLE incoming_keys ({keys}, PRIMARY KEY ({keys})) WITHOUT ROWID")
+        try:
+            conn.executemany(f"INSERT INTO temp.incoming_keys VALUES ({', '.join('?' for _ in key_columns)})",
+                             sqlite_rows(df[key_columns]))
+            changes_before = conn.total_changes
+            conn.execute(stale)
+            deleted = conn.total_changes - changes_before
+        finally:
+            conn.execute("DROP TABLE temp.incoming_keys")
+    return upserted, deleted
+
+# Write the weekly weather, fire alerts and merged tables to a SQLite database
+def write_sqlite(db_path, weather_df, fire_alerts_df, merged_df):
+    ensure_directory(os.path.dirname(os.path.abspath(db_path)))
+    size_before = os.path.getsize(db_path) if os.path.exists(db_path) else 0
+    conn = connect_sqlite(db_path)
+    try:
+        for table, df in zip(SQLITE_TABLES, [weather_df, fire_alerts_df, merged_df]):
+            changed, deleted = upsert_sqlite(conn, df, table, SQLITE_TABLES[table])
+            logger.info("SQLite table %s: %d of %d rows inserted or updated, %d stale rows deleted",
+                        table, changed, len(df), deleted)
+            record_metrics(rows_out=changed + deleted)
+    finally:
+        conn.close()
+    record_metrics(bytes_written=max(os.path.getsize(db_path) - size_before, 0))
+    return db_path
+
+# A pipeline stage: the stages it depends on and a function of their results
+Stage = namedtuple('Stage', ['deps', 'run'])
+
+# Validate a stage output as the stage produces it, without reading it back; violations are logged
+# with their counts and recorded in the stage metrics ('report'), or the first one raises ValidationError
+# ('fail-fast'), which fails the stage before its result is recorded in the manifest. A stage
+# without an output fails with a ValueError naming it
+def validate_output(df, checks, stage, validation=DEFAULT_VALIDATION):
+    if df is None:
+        raise ValueError(f"{stage} produced no output")
+    if validation is None:
+        return df
+    report = validate_frame(df, checks, fail_fast=validation == 'fail-fast', source=stage)
+    record_metrics(violations=sum(entry['violations'] for entry in report.values()))
+    for line in format_report(report):
+        logger.warning("Validation failed: %s", line)
+    return df
+
+# The pipeline as a dependency graph; the weather and fire alerts branches only meet at the merge,
+# which joins the fire alerts to the weather of `country` (by default the first of `countries`, or
+# COUNTRY when all are aggregated), one of the aggregated countries
+# With `sqlite_path`, a final stage upserts the weekly tables into that SQLite database, and with
+# `stations` another stage joins the fire alerts to their nearest weather station (see join_stations),
+# when the raw fire alerts are located by coordinates, up to `station_max_km` from the station.
+# The raw files are fetched from Kaggle unless another fetch `backend` is given (see fetch.py).
+# With `incremental`, the processing stages only read the lines appended to the raw files since the last run,
+# and with `processes` > 1 they split the raw files over that many worker processes
+def build_pipeline(output_dir, manifest, countries=COUNTRIES, window=WEEK_WINDOW, how='inner',
+                   chunksize=DEFAULT_CHUNK_SIZE, engine=DEFAULT_CSV_ENGINE, refresh=False, sqlite_path=None,
+                   validation=DEFAULT_VALIDATION, backend=None, incremental=False, processes=1, stations=False,
+                   station_max_km=DEFAULT_STATION_MAX_KM, country=None):
+    if country is None:
+        country = countries[0] if countries else COUNTRY
+    if countries is not None and country not in countries:
+        raise ValueError(f"The merge country {country!r} is not among the aggregated countries {list(countries)}")
+    weather_path = os.path.join(output_dir, WEATHER_WEEKLY_DATASET)
+    weather_state_path = os.path.join(output_dir, f'{WEATHER_STATE_NAME}.parquet')
+    fire_alerts_path = os.path.join(output_dir, f'{FIRE_ALERTS_WEEKLY_NAME}.parquet')
+    merged_path = os.path.join(output_dir, f'{MERGED_NAME}.parquet')
+    stations_path = os.path.join(output_dir, f'{STATION_WEEKLY_NAME}.parquet')
+
+    # Both downloads share one backend, so Kaggle is authenticated once, and run concurrently
+    # as independent stages; each keeps an up-to-date local copy and resumes partial downloads
+    backend = backend or kaggle_backend()
+
+    def download_weather(deps):
+        return download_csv_from_kaggle(WEATHER_DATASET, WEATHER_FILE_NAME, output_dir, backend, manifest)
+
+    def download_fire_alerts(deps):
+        return download_csv_from_kaggle(FIRE_ALERTS_DATASET, FIRE_ALERTS_FILE_NAME, output_dir, backend, manifest)
+
+    # In incremental mode a raw file is identified by its size and modification time instead of
+    # its content hash, so that appending a day does not cost a pass over the whole file. The processing
+    # stages store their high-water marks with their state and record them in the manifest; clearing
+    # the manifest entry (`refresh`) makes them rebuild their state
+    def raw_input(csv_file, stage, params):
+        if not incremental:
+            return [csv_file], params, None
+        stat = os.stat(csv_file)
+        state = manifest.setdefault('incremental', {}).setdefault(stage, {})
+        if refresh:
+            state.clear()
+        return [], {**params, 'source': [csv_file, stat.st_size, stat.st_mtime_ns]}, state
+
+    def weather(deps):
+        weather_csv = deps['download_weather']
+        input_files, params, state = raw_input(weather_csv, 'process_weather_data', {
+            'countries': countries, 'window': window, 'rename': WEATHER_COLUMN_NAMES,
+            'aggregation': WEATHER_AGGREGATION, 'schema': WEATHER_SCHEMA, 'incremental': incremental
+        })
+        return run_cached_stage(
+            manifest, 'process_weather_data', process_weather_data, input_files, params,
+            weather_path,
+            lambda: validate_output(
+                process_weather_data(weather_csv, output_dir, countries=countries, window=window,
+                                     chunksize=chunksize, engine=engine, state=state, processes=processes),
+                weather_weekly_checks(['country', 'year', 'week']), 'process_weather_data', validation
+            ),
+            read_intermediate, refresh=refresh
+        )
 
+    def fire_alerts(deps):
+        fire_alerts_csv = deps['download_fire_alerts']
+        input_files, params, state = raw_input(fire_alerts_csv, 'process_fire_alerts_data', {
+            'window': window, 'aggregation': FIRE_ALERTS_AGGREGATION, 'schema': FIRE_ALERTS_SCHEMA,
+            'incremental': incremental
+        })
+        return run_cached_stage(
+            manifest, 'process_fire_alerts_data', process_fire_alerts_data, input_files, params,
+            fire_alerts_path,
+            lambda: validate_output(
+                process_fire_alerts_data(fire_alerts_csv, output_dir, window=window, chunksize=chunksize,
+                                         engine=engine, state=state, processes=processes),
+                fire_alerts_weekly_checks(), 'process_fire_alerts_data', validation
+            ),
+            read_intermediate, refresh=refresh
+        )
+
+    # The merge is fingerprinted on the content of the weekly data it consumes.
+    # In incremental mode, the merged output stores the high-water marks of the weekly data it was
+    # built from. The weeks updated by the processing stages (none when a stage was skipped) are merged
+    # into the previous output only when it was built up to the marks the stages resumed from, so
+    # weeks folded in by a run that stopped before its merge are not lost; otherwise all weeks are merged
+    def merge(deps):
+        previous, yearweeks, marks = None, None, None
+        entry = manifest['stages'].get('merge_datasets')
+        if incremental:
+            marks = {'process_weather_data': parquet_metadata(weather_state_path).get('high_water_mark'),
+                     'process_fire_alerts_data': parquet_metadata(fire_alerts_path).get('high_water_mark')}
+            resumed = {stage: deps[stage].attrs.get('resumed_from', mark) for stage, mark in marks.items()}
+            updates = [deps[stage].attrs.get('updated_yearweeks', []) for stage in marks]
+            if (not refresh and entry and entry['params']['how'] == how
+                    and entry['params']['country'] == country and all(update is not None for update in updates)
+                    and all(resumed.values()) and parquet_metadata(merged_path).get('high_water_marks') == resumed):
+                previous, yearweeks = read_intermediate(merged_path), sorted(set(updates[0]) | set(updates[1]))
+
+        # The merge takes the weather handed over by its dependency, which may come from elsewhere than
+        # this directory's dataset (see pipeline-merged.py); when only some weeks are spliced into the
+        # previous output, only the span of those weeks is selected
+        merge_window = window
+        if yearweeks:
+            merge_window = tuple(divmod(int(key), 100) for key in (yearweeks[0], yearweeks[-1]))
+
+        return run_cached_stage(
+            manifest, 'merge_datasets', merge_datasets, [],
+            {'how': how, 'country': country,
+             'weather': dataframe_hash(select_country(deps['process_weather_data'], country)),
+             'fire_alerts': dataframe_hash(deps['process_fire_alerts_data'])},
+            merged_path,
+            lambda: validate_output(
+                merge_datasets(deps['process_weather_data'], deps['process_fire_alerts_data'], output_dir,
+                               country=country, how=how,
+                               previous=previous, yearweeks=yearweeks, window=merge_window,
+                               metadata=None if marks is None else {'high_water_marks': marks}),
+                merged_checks(how), 'merge_datasets', validation
+            ),
+            read_intermediate, refresh=refresh
+        )
+
+    # The published fire alerts are located by region only; without coordinates in the raw files the
+    # join is skipped with a warning (result None), so the other stages and the exports still run
+    def join(deps):
+        weather_csv, fire_alerts_csv = deps['download_weather'], deps['download_fire_alerts']
+        error = location_columns_error(weather_csv, fire_alerts_csv)
+        if error is not None:
+            logger.warning("Skipping join_stations: %s", error)
+            return None
+        return run_cached_stage(
+            manifest, 'join_stations', join_stations, [weather_csv, fire_alerts_csv],
+            {'countries': countries, 'window': window, 'aggregation': STATION_WEATHER_AGGREGATION,
+             'schema': [STATION_WEATHER_SCHEMA, LOCATED_FIRE_ALERTS_SCHEMA], 'max_km': station_max_km},
+            stations_path,
+            lambda: validate_output(
+                join_stations(weather_csv, fire_alerts_csv, output_dir, countries=countries, window=window,
+                              chunksize=chunksize, engine=engine, processes=processes, max_km=station_max_km),
+                station_checks(), 'join_stations', validation
+            ),
+            read_intermediate, refresh=refresh
+        )
+
+    def sqlite(deps):
+        return write_sqlite(sqlite_path, deps['process_weather_data'], deps['process_fire_alerts_data'],
+                            deps['merge_datasets'])
+
+    stages = {
+        'download_weather': Stage([], download_weather),
+        'download_fire_alerts': Stage([], download_fire_alerts),
+        'process_weather_data': Stage(['download_weather'], weather),
+        'process_fire_alerts_data': Stage(['download_fire_alerts'], fire_alerts),
+        'merge_datasets': Stage(['process_weather_data', 'process_fire_alerts_data'], merge)
+    }
+    if stations:
+        stages['join_stations'] = Stage(['download_weather', 'download_fire_alerts'], join)
+    if sqlite_path is not None:
+        stages['write_sqlite'] = Stage(['process_weather_data', 'process_fire_alerts_data', 'merge_datasets'], sqlite)
+    return stages
+
+# Run a stage and collect its metrics: wall time, CPU time of its thread, the process peak RSS
+# after it, and the rows and bytes recorded by the readers and writers it called.
+# With `profile_dir`, the stage runs under cProfile and its profile is dumped to <stage>.prof
+def run_instrumented(name, stage, deps, profile_dir=None):
+    metrics = {'stage': name}
+    _stage_metrics.current = metrics
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        if profile_dir is None:
+            result = stage.run(deps)
+        else:
+            with _profile_lock:
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    result = stage.run(deps)
+                finally:
+                    profiler.disable()
+                    ensure_directory(profile_dir)
+                    profiler.dump_stats(os.path.join(profile_dir, f'{name}.prof'))
+    finally:
+        _stage_metrics.current = None
+
+    metrics['wall_s'] = time.perf_counter() - wall_start
+    metrics['cpu_s'] = time.thread_time() - cpu_start
+    metrics['peak_rss_mb'] = peak_rss_mb()
+    if isinstance(result, pd.DataFrame):
+        metrics.setdefault('rows_out', len(result))
+    return result, metrics
+
+# Log the stage metrics as a summary table and optionally append them as JSON lines to `metrics_file`
+def report_metrics(stage_metrics, total_wall_s, metrics_file=None):
+    columns = ['wall_s', 'cpu_s', 'peak_rss_mb', 'rows_in', 'rows_out', 'bytes_read', 'bytes_written', 'violations']
+    lines = [f"{'stage':<28}" + ''.join(f"{column:>15}" for column in columns) + f"{'cached':>8}"]
+    for metrics in sorted(stage_metrics, key=lambda item: -item['wall_s']):
+        cells = []
+        for column in columns:
+            value = metrics.get(column)
+            cells.append(f"{'-' if value is None else (f'{value:.2f}' if isinstance(value, float) else value):>15}")
+        lines.append(f"{metrics['stage']:<28}" + ''.join(cells) + f"{'yes' if metrics.get('cached') else 'no':>8}")
+    lines.append(f"{'total':<28}{total_wall_s:>15.2f}")
+    logger.info("Stage metrics:\n%s", '\n'.join(lines))
+
+    if metrics_file is not None:
+        run_at = datetime.now(timezone.utc).isoformat()
+        with open(metrics_file, 'a') as f:
+            for metrics in stage_metrics:
+                f.write(json.dumps({'run_at': run_at, **metrics}) + '\n')
+
+# Execute the stages needed for `targets` on a thread pool, each as soon as its dependencies are done
+# `results` may provide the results of some stages up front, which are then not run.
+# The metrics of every stage are reported, and appended to the `metrics` list when one is given
+def run_graph(stages, targets=None, results=None, max_workers=DEFAULT_WORKERS,
+              metrics=None, metrics_file=None, profile_dir=None):
+    results = dict(results or {})
+
+    # Collect the stages the targets depend on
+    needed = set()
+    stack = list(targets or stages)
+    while stack:
+        name = stack.pop()
+        if name in needed or name in results:
+            continue
+        needed.add(name)
+        stack.extend(stages[name].deps)
+
+    stage_metrics = []
+    pending = set(needed)
+    running = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for name in sorted(pending):
+                if all(dep in results for dep in stages[name].deps):
+                    pending.discard(name)
+                    deps = {dep: results[dep] for dep in stages[name].deps}
+                    running[pool.submit(run_instrumented, name, stages[name], deps, profile_dir)] = name
+
+            if not running:
+                raise ValueError(f"Stages with unresolvable dependencies: {sorted(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name], stage_result_metrics = future.result()
+                stage_metrics.append(stage_result_metrics)
+
+    report_metrics(stage_metrics, time.perf_counter() - start, metrics_file)
+    if metrics is not None:
+        metrics.extend(stage_metrics)
+    return results
+
+# Log to stderr; verbose mode enables the debug diagnostics, quiet mode only keeps warnings and errors
+def configure_logging(verbose=False, quiet=False):
+    level = logging.DEBUG if verbose else logging.WARNING if quiet else logging.INFO
+    logging.basicConfig(level=level, format='%(asctime)s %(levelname)s [%(threadName)s] %(message)s')
+
+def main():
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description='Process weather and fire alerts data from Kaggle.')
-    parser.add_argument('--output-dir', type=str, required=True, help='Directory to save the processed CSV files.')
+    parser.add_argument('--output-dir', type=str, required=True, help='Directory to save the processed datasets.')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Number of rows read at a time from the raw CSV files.')
+    parser.add_argument('--csv-engine', choices=['c', 'pyarrow'], default=DEFAULT_CSV_ENGINE, help='CSV parser used to read the input files.')
+    parser.add_argument('--export-csv', action='store_true', help='Also export the processed datasets as CSV files.')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached stage results and run every stage.')
+    parser.add_argument('--incremental', action='store_true', help='Only fold the lines appended to the raw files since the last run into the weekly data.')
+    parser.add_argument('--countries', nargs='+', default=COUNTRIES, help="Countries whose weekly weather is aggregated, or 'all'.")
+    parser.add_argument('--window', nargs=2, type=parse_yearweek, default=WEEK_WINDOW, metavar=('START', 'END'),
+                        help='First and last ISO week analysed, as YYYY-WW (default: 2018-41 2022-41).')
+    parser.add_argument('--whole-history', action='store_true', help='Analyse every week instead of a time window.')
+    parser.add_argument('--merge-country', type=str, default=None,
+                        help='Country whose weekly weather the fire alerts are merged with (default: the first of --countries).')
+    parser.add_argument('--merge-how', choices=['inner', 'left', 'outer'], default='inner', help='Join type of the weekly merge.')
+    parser.add_argument('--mirror', type=str, default=None, help='Directory standing in for Kaggle, laid out as <owner>/<dataset>/<file>.')
+    parser.add_argument('--stations', action='store_true', help='Also join the fire alerts to their nearest weather station; needs fire alerts located by latitude and longitude.')
+    parser.add_argument('--station-max-km', type=float, default=DEFAULT_STATION_MAX_KM,
+                        help='Largest distance in km at which a fire alert is joined to its nearest weather station.')
+    parser.add_argument('--sqlite', type=str, default=None, help='SQLite database the weekly tables are upserted into.')
+    parser.add_argument('--validation', choices=['report', 'fail-fast', 'off'], default=DEFAULT_VALIDATION,
+                        help='Log every violation of the output checks, stop at the first one, or skip the checks.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of stages run concurrently.')
+    parser.add_argument('--processes', type=int, default=1, help='Worker processes each raw file is aggregated with.')
+    parser.add_argument('--metrics-file', type=str, default=None, help='File the per-stage metrics are appended to as JSON lines.')
+    parser.add_argument('--profile-dir', type=str, default=None, help='Directory for a cProfile dump of every stage.')
+    parser.add_argument('--verbose', action='store_true', help='Log debug diagnostics such as DataFrame heads.')
+    parser.add_argument('--quiet', action='store_true', help='Only log warnings and errors.')
     args = parser.parse_args()
+    configure_logging(verbose=args.verbose, quiet=args.quiet)
 
     # Output directory
     output_dir = args.output_dir
     ensure_directory(output_dir)
+    manifest = load_manifest(output_dir)
 
-    # Download the CSV files from Kaggle
-    weather_csv = download_csv_from_kaggle(weather_dataset, weather_file_name, output_dir)
-    fire_alerts_csv = download_csv_from_kaggle(fire_alerts_dataset, fire_alerts_file_name, output_dir)
-
-    # Process the weather data
-    process_weather_data(weather_csv, output_dir)
+    # Run the download, processing and merge stages as a dependency graph
+    countries = None if args.countries == ['all'] else args.countries
+    window = None if args.whole_history else tuple(args.window)
+    stages = build_pipeline(output_dir, manifest, countries=countries, window=window, how=args.merge_how,
+                            chunksize=args.chunk_size, engine=args.csv_engine, refresh=args.refresh,
+                            sqlite_path=args.sqlite, validation=None if args.validation == 'off' else args.validation,
+                            backend=mirror_backend(args.mirror) if args.mirror else None, incremental=args.incremental,
+                            processes=args.processes, stations=args.stations,
+                            station_max_km=args.station_max_km, country=args.merge_country)
+    results = run_graph(stages, max_workers=args.workers, metrics_file=args.metrics_file, profile_dir=args.profile_dir)
+    save_manifest(manifest, output_dir)
 
-    # Process the fire alerts data
-    process_fire_alerts_data(fire_alerts_csv, output_dir)
-    
-    # Paths to the processed CSV files
-    processed_weather_csv = os.path.join(output_dir, 'greece_weather_weekly_aggregated.csv')
-    processed_fire_alerts_csv = os.path.join(output_dir, 'processed_fire_alerts_aggregated.csv')
-    
-    # Merge the datasets
-    merge_datasets(processed_weather_csv, processed_fire_alerts_csv, output_dir)
+    # Optionally export the stage outputs as CSV
+    if args.export_csv:
+        weather_df = results['process_weather_data']
+        for country in weather_df['country'].unique():
+            export_csv(select_country(weather_df, country), output_dir, weather_weekly_name(country))
+        export_csv(results['process_fire_alerts_data'], output_dir, FIRE_ALERTS_WEEKLY_NAME)
+        export_csv(results['merge_datasets'], output_dir, MERGED_NAME)
+        if results.get('join_stations') is not None:
+            export_csv(results['join_stations'], output_dir, STATION_WEEKLY_NAME)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,252 @@
+from collections import namedtuple
+
+# A step of a query plan. `kind` is 'scan', 'derive', 'filter', 'select', 'rename' or 'aggregate';
+# `inputs` are the columns it reads and `outputs` the columns it writes. Derives and filters compute
+# a column or a row mask from a column getter, `func(get)`, so the optimiser can rewrite the columns
+# they read when it moves them; `params` holds the schema, columns, mapping or aggregation of the
+# other kinds and `label` describes the step (see explain)
+Step = namedtuple('Step', ['kind', 'inputs', 'outputs', 'func', 'params', 'label'])
+
+# Aggregations that can be folded chunk by chunk into mergeable sums and counts
+AGGREGATIONS = ('sum', 'mean')
+
+# A plan is a tuple of steps that starts with a scan of the declared columns; nothing runs until execute
+def scan(schema):
+    return (Step('scan', [], list(schema), None, dict(schema), 'scan'),)
+
+# Add (or replace) `column`, computed from the `inputs` columns
+def derive(plan, column, inputs, func, label=None):
+    return plan + (Step('derive', list(inputs), [column], func, None, label or f'derive {column}'),)
+
+# Keep the rows for which `func` is true
+def where(plan, inputs, func, label):
+    return plan + (Step('filter', list(inputs), [], func, None, label),)
+
+# Keep the rows whose `column` is one of `values`
+def isin(plan, column, values):
+    values = list(values)
+    return where(plan, [column], lambda get: get(column).isin(values), f'{column} in {values}')
+
+# Keep the rows whose `column` lies between `low` and `high` (inclusive)
+def between(plan, column, low, high):
+    return where(plan, [column], lambda get: get(column).between(low, high), f'{low} <= {column} <= {high}')
+
+# Keep only `columns`
+def select(plan, columns):
+    return plan + (Step('select', list(columns), [], None, list(columns), f'select {list(columns)}'),)
+
+# Rename columns
+def rename(plan, mapping):
+    return plan + (Step('rename', list(mapping), list(mapping.values()), None, dict(mapping), f'rename {mapping}'),)
+
+# Group by `keys` and aggregate the columns of `aggregations` ('sum' or 'mean'); always the last step.
+# `names` maps the columns the aggregation reads to the names of its output (set by rename fusion)
+def aggregate(plan, keys, aggregations):
+    for column, how in aggregations.items():
+        if how not in AGGREGATIONS:
+            raise ValueError(f"Unsupported aggregation {how!r} of {column!r}")
+    params = {'keys': list(keys), 'aggregations': dict(aggregations), 'names': {}}
+    return plan + (Step('aggregate', list(keys) + list(aggregations), [], None, params, f'aggregate by {list(keys)}'),)
+
+# A derive that replaces a column with a function of itself, such as cleaning it
+def is_map(step):
+    return step.kind == 'derive' and step.outputs[0] in step.inputs
+
+# Rewrite a step that reads columns through `read(get, name)` instead of `get(name)`
+def rewrite(step, read, inputs):
+    func = step.func
+    return step._replace(func=lambda get: func(lambda name: read(get, name)), inputs=inputs)
+
+# Move a step from after a rename to before it, reading and writing the original names
+def before_rename(step, mapping):
+    inverse = {new: old for old, new in mapping.items()}
+    inputs = [inverse.get(column, column) for column in step.inputs]
+    if step.kind == 'select':
+        return step._replace(inputs=inputs, params=inputs)
+    return rewrite(step, lambda get, name: get(inverse.get(name, name)), inputs)._replace(
+        outputs=[inverse.get(column, column) for column in step.outputs])
+
+# Fuse the renames into the aggregation: the steps after a rename are rewritten to the original
+# names and the aggregation names its output, so no chunk is ever renamed. A rename is kept
+# when a later derive writes one of its names
+def fuse_renames(steps, agg):
+    for i in reversed(range(len(steps))):
+        step = steps[i]
+        if step.kind != 'rename':
+            continue
+        mapping = step.params
+        later = steps[i + 1:]
+        if any(set(later_step.outputs) & (set(mapping) | set(mapping.values())) for later_step in later
+               if later_step.kind == 'derive'):
+            break
+
+        inverse = {new: old for old, new in mapping.items()}
+        names = agg.params['names']
+        keys = [inverse.get(column, column) for column in agg.params['keys']]
+        aggregations = {inverse.get(column, column): how for column, how in agg.params['aggregations'].items()}
+        names = {inverse.get(column, column): names.get(column, column) for column in agg.inputs}
+        agg = agg._replace(inputs=keys + list(aggregations),
+                           params={'keys': keys, 'aggregations': aggregations, 'names': names})
+        steps = steps[:i] + [before_rename(later_step, mapping) for later_step in later]
+    return steps, agg
+
+# Check that no step reads a column dropped by an earlier select, then drop the selects:
+# the projection pushed into the scan keeps only the columns that are read anyway
+def drop_selects(steps, agg, columns):
+    available = set(columns)
+    for step in steps + [agg]:
+        missing = [column for column in step.inputs if column not in available]
+        if missing:
+            raise ValueError(f"Step '{step.label}' reads columns that are not available: {missing}")
+        if step.kind == 'select':
+            available = set(step.params)
+        elif step.kind == 'rename':
+            available = {step.params.get(column, column) for column in available}
+        available |= set(step.outputs)
+    return [step for step in steps if step.kind != 'select']
+
+# Swap two adjacent steps when that moves a filter towards the scan or a map further from it;
+# a filter moved before a map of a column it reads applies that map itself
+def swapped(first, second):
+    if second.kind == 'filter' and first.kind == 'derive':
+        column = first.outputs[0]
+        if column not in second.inputs:
+            return second, first
+        if is_map(first):
+            return rewrite(second, lambda get, name: first.func(get) if name == column else get(name),
+                           second.inputs), first
+    if second.kind == 'derive' and not is_map(second) and is_map(first) and first.outputs[0] not in second.inputs \
+            and first.outputs[0] not in second.outputs:
+        return second, first
+    return None
+
+# Push filters down to the scan (so rows are dropped before the columns they do not need are
+# derived) and maps up to the last steps that do not need them
+def push_filters(steps):
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(steps) - 1):
+            swap = swapped(steps[i], steps[i + 1])
+            if swap is not None:
+                steps[i], steps[i + 1] = swap
+                changed = True
+    return steps
+
+# Drop the derives whose column nothing reads, and return the remaining steps with the columns
+# the scan has to provide
+def drop_dead_derives(steps, agg):
+    needed = set(agg.inputs)
+    live = []
+    for step in reversed(steps):
+        if step.kind == 'derive':
+            if step.outputs[0] not in needed:
+                continue
+            needed -= set(step.outputs)
+        elif step.kind == 'rename':
+            inverse = {new: old for old, new in step.params.items()}
+            needed = {inverse.get(column, column) for column in needed}
+        needed |= set(step.inputs)
+        live.append(step)
+    return live[::-1], needed
+
+# Optimise a plan: fuse renames into the aggregation, drop selects and dead derives, push filters
+# down to the scan and project the scan onto the columns that are read
+def optimize(plan):
+    if plan[0].kind != 'scan' or plan[-1].kind != 'aggregate' or \
+            any(step.kind in ('scan', 'aggregate') for step in plan[1:-1]):
+        raise ValueError("A plan is a scan, then derives, filters, selects and renames, then one aggregation")
+    scan_step, steps, agg = plan[0], list(plan[1:-1]), plan[-1]
+
+    steps, agg = fuse_renames(steps, agg)
+    steps = drop_selects(steps, agg, scan_step.outputs)
+    steps, needed = drop_dead_derives(push_filters(steps), agg)
+    schema = {column: dtype for column, dtype in scan_step.params.items() if column in needed}
+    return (scan_step._replace(outputs=list(schema), params=schema), *steps, agg)
+
+# Human readable steps of a plan, one per line
+def explain(plan):
+    lines = []
+    for step in plan:
+        if step.kind == 'scan':
+            lines.append(f"scan {step.outputs}")
+        elif step.kind == 'aggregate':
+            aggregations = ', '.join(f"{how}({column})" for column, how in step.params['aggregations'].items())
+            renamed = {column: name for column, name in step.params['names'].items() if column != name}
+            lines.append(f"{step.label}: {aggregations}" + (f" as {renamed}" if renamed else ''))
+        else:
+            lines.append(f"{step.kind} {step.label}")
+    return lines
+
+# Run a plan over the chunks of `read(schema, predicate)`, which streams the projected scan columns
+# and drops the rows the predicate rejects while parsing. The plan is optimised first: the filters
+# pushed down to the scan become that predicate, the other steps run chunk by chunk and the
+# aggregation folds every chunk into running per-key sums, plus non-null counts for means.
+# Returns the sums, the counts (None without means) and the number of aggregated rows, under the
+# output names; see finalize for the aggregates. With `optimized=False` the steps run as written,
+# which gives the same result and serves as the reference the optimiser is checked against
+def execute(plan, read, optimized=True):
+    if optimized:
+        plan = optimize(plan)
+    scan_step, steps, agg = plan[0], list(plan[1:-1]), plan[-1]
+    pushed = []
+    while steps and steps[0].kind == 'filter':
+        pushed.append(steps.pop(0).func)
+
+    predicate = None
+    if pushed:
+        def predicate(chunk):
+            mask = pushed[0](chunk.__getitem__)
+            for func in pushed[1:]:
+                mask &= func(chunk.__getitem__)
+            return mask
+
+    keys = agg.params['keys']
+    values = list(agg.params['aggregations'])
+    means = [column for column, how in agg.params['aggregations'].items() if how == 'mean']
+    sums = None
+    counts = None
+    rows = 0
+    for chunk in read(scan_step.params, predicate):
+        for step in steps:
+            if step.kind == 'derive':
+                chunk = chunk.assign(**{step.outputs[0]: step.func(chunk.__getitem__)})
+            elif step.kind == 'filter':
+                chunk = chunk[step.func(chunk.__getitem__)]
+            elif step.kind == 'select':
+                chunk = chunk[step.params]
+            else:
+                chunk = chunk.rename(columns=step.params)
+        rows += len(chunk)
+
+        # Fold the partial sums and non-null counts of this chunk into the running state
+        grouped = chunk.groupby(keys)[values]
+        chunk_sums = grouped.sum()
+        chunk_counts = grouped.count()[means] if means else None
+        if sums is None:
+            sums, counts = chunk_sums, chunk_counts
+        else:
+            sums = sums.add(chunk_sums, fill_value=0)
+            if means:
+                counts = counts.add(chunk_counts, fill_value=0)
+
+    if sums is None:
+        return None, None, rows
+    names = agg.params['names']
+    for state in [sums, counts] if means else [sums]:
+        state.rename(columns=names, inplace=True)
+        state.index.names = [names.get(key, key) for key in keys]
+    return sums, counts, rows
+
+# The aggregates of a plan from the (possibly combined) sums and counts returned by execute;
+# means of groups without any value are NaN
+def finalize(plan, sums, counts):
+    agg = plan[-1]
+    names = agg.params['names']
+    means = [names.get(column, column) for column, how in agg.params['aggregations'].items() if how == 'mean']
+    if not means:
+        return sums
+    averaged = sums[means] / counts[means]
+    if len(means) == sums.shape[1]:
+        return averaged
+    return sums.assign(**{column: averaged[column] for column in means})
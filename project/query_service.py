@@ -0,0 +1,212 @@
+import os
+import json
+import argparse
+import threading
+import socketserver
+from functools import lru_cache
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+from pipeline import configure_logging, logger, read_intermediate, yearweek_key, parse_yearweek, MERGED_NAME
+
+# Query results kept per loaded version of the merged data
+DEFAULT_CACHE_SIZE = 256
+
+# Port of the HTTP front end
+DEFAULT_PORT = 8765
+
+# Aggregations the aggregate query supports
+AGGREGATE_FUNCTIONS = ('mean', 'sum', 'min', 'max', 'count')
+
+# Columns the range and aggregate queries can group by
+GROUP_COLUMNS = ('year', 'week')
+
+# The query service: `query(kind, **params)` answers a 'range', 'aggregate' or 'correlation' query
+# and `info()` describes the loaded data and the cache
+QueryService = namedtuple('QueryService', ['query', 'info'])
+
+# The merged output of a pipeline output directory: the Parquet intermediate, else the exported CSV
+def merged_path(output_dir):
+    for name in (f'{MERGED_NAME}.parquet', f'{MERGED_NAME}.csv'):
+        path = os.path.join(output_dir, name)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No merged output in {output_dir}")
+
+# Load the merged data sorted by its yearweek key, which serves as the index of the range lookups.
+# The float32 measurements are converted through their decimal text, so 26.8 stays 26.8
+def load_merged(path):
+    df = read_intermediate(path) if path.endswith('.parquet') else pd.read_csv(path)
+    for column in df.columns:
+        if df[column].dtype == 'float32':
+            df[column] = df[column].astype(str).astype('float64')
+    keys = yearweek_key(df['year'], df['week'])
+    order = np.argsort(keys, kind='stable')
+    return df.iloc[order].reset_index(drop=True), keys[order]
+
+# The rows of the weeks from `start` to `end` (inclusive, (year, week) tuples or None for open ends),
+# found by binary search on the sorted keys
+def week_range(df, keys, start=None, end=None):
+    low = 0 if start is None else np.searchsorted(keys, yearweek_key(*start), side='left')
+    high = len(keys) if end is None else np.searchsorted(keys, yearweek_key(*end), side='right')
+    return df.iloc[low:high]
+
+# JSON-ready records of a DataFrame, with NaN as None
+def records(df):
+    return json.loads(df.to_json(orient='records', double_precision=15))
+
+# Check that the columns exist in the merged data
+def check_columns(df, columns):
+    missing = [column for column in columns if column not in df.columns]
+    if missing:
+        raise ValueError(f"Unknown columns: {missing}")
+
+# Rows of a range of weeks, optionally only some columns
+def range_query(df, keys, start=None, end=None, columns=None):
+    rows = week_range(df, keys, start, end)
+    if columns is not None:
+        check_columns(df, columns)
+        rows = rows[['year', 'week'] + [column for column in columns if column not in ('year', 'week')]]
+    return {'rows': records(rows)}
+
+# Aggregate of columns over a range of weeks, overall or per year or week
+def aggregate_query(df, keys, columns, func='mean', by=None, start=None, end=None):
+    if func not in AGGREGATE_FUNCTIONS:
+        raise ValueError(f"Unsupported aggregation {func!r}, expected one of {list(AGGREGATE_FUNCTIONS)}")
+    if by is not None and by not in GROUP_COLUMNS:
+        raise ValueError(f"Cannot group by {by!r}, expected one of {list(GROUP_COLUMNS)}")
+    check_columns(df, columns)
+    rows = week_range(df, keys, start, end)
+    if by is None:
+        return {'result': json.loads(rows[list(columns)].agg(func).to_json(double_precision=15))}
+    return {'result': records(rows.groupby(by)[list(columns)].agg(func).reset_index())}
+
+# Pearson correlation of two columns over a range of weeks, overall or per year
+def correlation_query(df, keys, x, y, by=None, start=None, end=None):
+    if by is not None and by not in GROUP_COLUMNS:
+        raise ValueError(f"Cannot group by {by!r}, expected one of {list(GROUP_COLUMNS)}")
+    check_columns(df, [x, y])
+    rows = week_range(df, keys, start, end)
+    if by is None:
+        return {'result': json.loads(pd.Series({'correlation': rows[x].corr(rows[y])}).to_json(double_precision=15))}
+    correlation = pd.DataFrame({by: group, 'correlation': rows_of_group[x].corr(rows_of_group[y])}
+                               for group, rows_of_group in rows.groupby(by))
+    return {'result': records(correlation)}
+
+QUERIES = {'range': range_query, 'aggregate': aggregate_query, 'correlation': correlation_query}
+
+# Normalise query parameters given as strings (e.g. from a URL) or Python values into a hashable
+# cache key: weeks as (year, week) tuples and column lists as tuples
+def normalize_params(params):
+    normalized = {}
+    for name, value in params.items():
+        if value is None or value == '':
+            continue
+        if name in ('start', 'end') and isinstance(value, str):
+            value = parse_yearweek(value)
+        elif name == 'columns':
+            value = value.split(',') if isinstance(value, str) else value
+        normalized[name] = tuple(value) if isinstance(value, list) else value
+    return tuple(sorted(normalized.items()))
+
+# Serve queries over the merged output of `output_dir` from memory. Results are kept in an LRU
+# cache of `cache_size` entries; before every query the output file is checked (one stat call) and
+# reloaded with a fresh cache when the pipeline wrote a new version. A version that cannot be read
+# yet, e.g. while it is being written, leaves the loaded data in place until the next query
+def query_service(output_dir, cache_size=DEFAULT_CACHE_SIZE):
+    lock = threading.Lock()
+    loaded = {}
+
+    def current():
+        path = merged_path(output_dir)
+        stat = os.stat(path)
+        version = (path, stat.st_size, stat.st_mtime_ns)
+        with lock:
+            if loaded.get('version') != version:
+                try:
+                    df, keys = load_merged(path)
+                except Exception as e:
+                    if 'run' not in loaded:
+                        raise
+                    logger.warning("Keeping the loaded merged data, reading %s failed: %s", path, e)
+                    return loaded
+                run = lru_cache(maxsize=cache_size)(
+                    lambda kind, params: QUERIES[kind](df, keys, **dict(params)))
+                loaded.update(version=version, run=run, path=path, rows=len(df))
+                logger.info("Loaded %d weeks of merged data from %s", len(df), path)
+            return loaded
+
+    def query(kind, **params):
+        if kind not in QUERIES:
+            raise ValueError(f"Unknown query {kind!r}, expected one of {list(QUERIES)}")
+        return current()['run'](kind, normalize_params(params))
+
+    def info():
+        state = current()
+        return {'path': state['path'], 'rows': state['rows'], 'cache': state['run'].cache_info()._asdict()}
+
+    return QueryService(query, info)
+
+# HTTP request handler answering GET /range, /aggregate, /correlation and /info with JSON;
+# the query parameters are those of the query functions, e.g. /range?start=2021-20&end=2021-35
+def make_handler(service):
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            kind = url.path.strip('/')
+            params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            try:
+                body, status = (service.info() if kind == 'info' else service.query(kind, **params)), 200
+            except (ValueError, TypeError) as e:
+                body, status = {'error': str(e)}, 400
+            except FileNotFoundError as e:
+                body, status = {'error': str(e)}, 503
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug("Query service: " + format, *args)
+
+    return QueryHandler
+
+# HTTP over a Unix socket, one thread per connection
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve range, aggregate and correlation queries over the merged weekly data.')
+    parser.add_argument('--output-dir', type=str, required=True, help='Pipeline output directory with the merged data.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address the HTTP front end listens on.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port the HTTP front end listens on.')
+    parser.add_argument('--socket', type=str, default=None, help='Listen on this Unix socket instead of a TCP port.')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE, help='Number of query results kept in the LRU cache.')
+    parser.add_argument('--verbose', action='store_true', help='Log every request.')
+    args = parser.parse_args()
+    configure_logging(verbose=args.verbose)
+
+    service = query_service(args.output_dir, cache_size=args.cache_size)
+    service.info()
+    handler = make_handler(service)
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, handler)
+        logger.info("Serving queries on %s", args.socket)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        logger.info("Serving queries on http://%s:%d", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import numpy as np
+from collections import namedtuple
+
+# Mean Earth radius, for distances in km
+EARTH_RADIUS_KM = 6371.0088
+
+# Most points in a leaf of the KD-tree
+LEAF_SIZE = 8
+
+# A KD-tree over points on the unit sphere, with its nodes in breadth-first order: the 3-D unit
+# vectors of the points, the point positions ordered so each node covers a contiguous run of them,
+# per node the [start, end) of that run, the bounding box of its points and its two children
+# (-1 for leaves)
+KDTree = namedtuple('KDTree', ['points', 'order', 'starts', 'ends', 'lower', 'upper', 'children'])
+
+# Unit vectors of latitudes and longitudes in degrees; straight-line (chord) distances between them
+# order pairs of points like great-circle distances do, without trigonometry per pair
+def unit_vectors(latitude, longitude):
+    latitude = np.radians(np.asarray(latitude, dtype='float64'))
+    longitude = np.radians(np.asarray(longitude, dtype='float64'))
+    return np.column_stack([np.cos(latitude) * np.cos(longitude), np.cos(latitude) * np.sin(longitude),
+                            np.sin(latitude)])
+
+# Great-circle distance in km of a chord between two unit vectors
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+
+# KD-tree over points given by latitude and longitude: nodes are split at the median of their
+# widest dimension until they hold at most `leaf_size` points; O(m log m)
+def build_kdtree(latitude, longitude, leaf_size=LEAF_SIZE):
+    points = unit_vectors(latitude, longitude)
+    if not len(points):
+        raise ValueError("Cannot index an empty set of points")
+    order = np.arange(len(points))
+    ranges = [(0, len(points))]
+    lower, upper, children = [], [], []
+    for start, end in ranges:
+        block = points[order[start:end]]
+        lower.append(block.min(axis=0))
+        upper.append(block.max(axis=0))
+        if end - start <= leaf_size:
+            children.append((-1, -1))
+            continue
+        middle = (start + end) // 2
+        split = np.argpartition(block[:, np.argmax(upper[-1] - lower[-1])], middle - start)
+        order[start:end] = order[start:end][split]
+        children.append((len(ranges), len(ranges) + 1))
+        ranges += [(start, middle), (middle, end)]
+    starts, ends = np.array(ranges).T
+    return KDTree(points, order, starts, ends, np.array(lower), np.array(upper), np.array(children))
+
+# Distances from query points to the bounding boxes of nodes (0 inside a box)
+def box_distances(tree, queries, nodes):
+    below = np.maximum(tree.lower[nodes] - queries, 0)
+    above = np.maximum(queries - tree.upper[nodes], 0)
+    return np.linalg.norm(below + above, axis=1)
+
+# (query, point) pairs of the points of the leaves paired with queries, expanded at once
+def leaf_pairs(tree, owners, leaves):
+    counts = tree.ends[leaves] - tree.starts[leaves]
+    positions = np.repeat(tree.starts[leaves] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    return np.repeat(owners, counts), tree.order[positions]
+
+# Fold (query, point, chord) candidates into the `k` nearest points found so far per query,
+# kept closest first in `nearest` and `distances` (-1 and inf while fewer were found)
+def update_nearest(nearest, distances, owners, points, chords):
+    affected = np.unique(owners)
+    k = nearest.shape[1]
+    owners = np.concatenate([np.repeat(affected, k), owners])
+    points = np.concatenate([nearest[affected].ravel(), points])
+    chords = np.concatenate([distances[affected].ravel(), chords])
+    order = np.lexsort((chords, owners))
+    owners, points, chords = owners[order], points[order], chords[order]
+    rank = np.arange(len(owners)) - np.searchsorted(owners, owners, side='left')
+    keep = rank < k
+    nearest[owners[keep], rank[keep]] = points[keep]
+    distances[owners[keep], rank[keep]] = chords[keep]
+
+# The `k` indexed points nearest to each query point, for all queries at once: an (n, k) array of
+# point positions and one of great-circle distances in km, closest first.
+# Every query first descends to the leaf whose box is closest, which bounds its k-th distance;
+# then the tree is walked level by level for all queries together, visiting only the nodes whose box
+# lies closer than the query's current k-th distance, so n queries on m points take O(n log m)
+def nearest(tree, latitude, longitude, k=1):
+    queries = unit_vectors(latitude, longitude)
+    n = len(queries)
+    k = min(k, len(tree.points))
+    result = np.full((n, k), -1, dtype='int64')
+    distances = np.full((n, k), np.inf)
+
+    leaf = np.zeros(n, dtype='int64')
+    inner = tree.children[leaf, 0] >= 0
+    while inner.any():
+        left, right = tree.children[leaf[inner]].T
+        closer = box_distances(tree, queries[inner], left) <= box_distances(tree, queries[inner], right)
+        leaf[inner] = np.where(closer, left, right)
+        inner = tree.children[leaf, 0] >= 0
+    owners, points = leaf_pairs(tree, np.arange(n), leaf)
+    update_nearest(result, distances, owners, points, np.linalg.norm(queries[owners] - tree.points[points], axis=1))
+
+    owners, nodes = np.arange(n), np.zeros(n, dtype='int64')
+    while len(owners):
+        near = (box_distances(tree, queries[owners], nodes) < distances[owners, -1]) & (nodes != leaf[owners])
+        owners, nodes = owners[near], nodes[near]
+        leaves = tree.children[nodes, 0] < 0
+        if leaves.any():
+            leaf_owners, points = leaf_pairs(tree, owners[leaves], nodes[leaves])
+            chords = np.linalg.norm(queries[leaf_owners] - tree.points[points], axis=1)
+            update_nearest(result, distances, leaf_owners, points, chords)
+        owners, nodes = np.repeat(owners[~leaves], 2), tree.children[nodes[~leaves]].ravel()
+    return result, chord_to_km(distances)
@@ -1,42 +1,39 @@
 import os
-import pandas as pd
 import argparse
+import pyarrow.compute as pc
+from validation import (validate_file, format_report, weather_weekly_checks, fire_alerts_weekly_checks,
+                        merged_checks, station_checks)
 
-def test_pipeline(output_dir):
+def test_pipeline(output_dir, fail_fast=False):
     try:
         # Define paths to output files
-        weather_file = os.path.join(output_dir, 'greece_weather_weekly_aggregated.csv')
-        fire_alerts_file = os.path.join(output_dir, 'processed_fire_alerts_aggregated.csv')
-        merged_file = os.path.join(output_dir, 'merged_weather_fire_alerts.csv')
+        weather_file = os.path.join(output_dir, 'weather_weekly_aggregated')
+        fire_alerts_file = os.path.join(output_dir, 'processed_fire_alerts_aggregated.parquet')
+        merged_file = os.path.join(output_dir, 'merged_weather_fire_alerts.parquet')
+        stations_file = os.path.join(output_dir, 'station_weather_fire_alerts.parquet')
 
         # Check if output files exist
         assert os.path.exists(weather_file), f"File not found: {weather_file}"
         assert os.path.exists(fire_alerts_file), f"File not found: {fire_alerts_file}"
         assert os.path.exists(merged_file), f"File not found: {merged_file}"
 
-        # Load CSV files
-        weather_df = pd.read_csv(weather_file)
-        fire_alerts_df = pd.read_csv(fire_alerts_file)
-        merged_df = pd.read_csv(merged_file)
-
-        # Check the columns of the weather data
-        expected_weather_columns = ['year', 'week', 'temp.avg', 'temp.min', 'temp.max', 'winddir', 'windspd', 'pressure']
-        assert list(weather_df.columns) == expected_weather_columns, "Weather data columns do not match"
-
-        # Check the columns of the fire alerts data
-        expected_fire_alerts_columns = ['alert__year', 'alert__week', 'alert__count']
-        assert list(fire_alerts_df.columns) == expected_fire_alerts_columns, "Fire alerts data columns do not match"
-
-        # Check the columns of the merged data
-        expected_merged_columns = ['year', 'week', 'temp.avg', 'temp.min', 'temp.max', 'winddir', 'windspd', 'pressure', 'alert__count']
-        assert list(merged_df.columns) == expected_merged_columns, "Merged data columns do not match"
-
-        # Check for NaN values in key columns
-        assert weather_df[['temp.avg', 'temp.min', 'temp.max', 'winddir', 'windspd', 'pressure']].isnull().sum().sum() == 0, "NaN values found in weather data"
-        assert fire_alerts_df['alert__count'].isnull().sum() == 0, "NaN values found in fire alerts data"
-        assert merged_df[['temp.avg', 'temp.min', 'temp.max', 'winddir', 'windspd', 'pressure', 'alert__count']].isnull().sum().sum() == 0, "NaN values found in merged data"
-
-        print("All tests passed successfully!")
+        # Stream every intermediate once through its checks (schema, missing values, key uniqueness
+        # and order, week numbers and value ranges), collecting all violations
+        report = {}
+        report.update(validate_file(
+            weather_file, weather_weekly_checks(), columns=['year', 'week', 'temp.avg', 'temp.min', 'temp.max', 'winddir', 'windspd', 'pressure'],
+            filter=pc.field('country') == 'Greece', fail_fast=fail_fast
+        ))
+        report.update(validate_file(fire_alerts_file, fire_alerts_weekly_checks(), fail_fast=fail_fast))
+        report.update(validate_file(merged_file, merged_checks(), fail_fast=fail_fast))
+        # The per-station join only exists when the pipeline ran with --stations
+        if os.path.exists(stations_file):
+            report.update(validate_file(stations_file, station_checks(), fail_fast=fail_fast))
+
+        for line in format_report(report):
+            print(f"Test failed: {line}")
+        if not report:
+            print("All tests passed successfully!")
 
     except AssertionError as e:
         print(f"Test failed: {e}")
@@ -44,8 +41,9 @@ def test_pipeline(output_dir):
 if __name__ == "__main__":
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description='Test the data pipeline.')
-    parser.add_argument('--output-dir', type=str, required=True, help='Directory containing the output CSV files.')
+    parser.add_argument('--output-dir', type=str, required=True, help='Directory containing the pipeline intermediates.')
+    parser.add_argument('--fail-fast', action='store_true', help='Stop at the first failed check.')
     args = parser.parse_args()
 
     # Run tests
-    test_pipeline(args.output_dir)
+    test_pipeline(args.output_dir, fail_fast=args.fail_fast)
@@ -0,0 +1,356 @@
+import os
+import json
+import tempfile
+import numpy as np
+import pandas as pd
+from fetch import Backend, fetch_file, mirror_backend
+from plan import scan, derive, where, isin, between, select, rename, aggregate, optimize, explain, execute, finalize
+from generate_data import generate_dataset
+from spatial import build_kdtree, nearest, unit_vectors, chord_to_km
+from pipeline import (connect_sqlite, upsert_sqlite, join_stations, process_weather_data, process_fire_alerts_data, merge_sorted, iter_intermediate, write_intermediate, build_pipeline, run_graph, ensure_directory,
+                      load_manifest, save_manifest, Stage, WEATHER_MEASUREMENTS, WEATHER_DATASET, WEATHER_FILE_NAME,
+                      FIRE_ALERTS_DATASET, FIRE_ALERTS_FILE_NAME)
+
+# The streaming merge of sorted weekly sources gives the rows and columns of chained pd.merge calls,
+# for every join type and with empty sources, passed as DataFrames or as chunks of Parquet intermediates
+def test_merge_sorted_matches_pd_merge():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        for case in range(300):
+            frames = []
+            for i in range(rng.integers(2, 5)):
+                keys = np.sort(rng.choice(np.arange(201801, 201853), rng.integers(0, 20), replace=False))
+                frames.append(pd.DataFrame({'yearweek': keys.astype('int32'), f'value{i}': rng.normal(size=len(keys))}))
+            how = ['inner', 'left', 'outer'][case % 3]
+
+            expected = frames[0]
+            for frame in frames[1:]:
+                expected = expected.merge(frame, on='yearweek', how=how)
+            expected = expected.sort_values('yearweek', ignore_index=True)
+
+            sources = []
+            for i, frame in enumerate(frames):
+                if i % 2:
+                    sources.append(iter_intermediate(write_intermediate(frame, tmp, f'source{i}'), batch_size=3))
+                else:
+                    sources.append(frame)
+            actual = pd.concat(list(merge_sorted(sources, how=how)), ignore_index=True)
+            pd.testing.assert_frame_equal(actual, expected, check_dtype=False, check_index_type=False)
+
+# Run the pipeline over the raw files of a mirror and save its manifest, like the command line does
+def run_pipeline(output_dir, mirror, incremental, fail_stage=None):
+    ensure_directory(output_dir)
+    manifest = load_manifest(output_dir)
+    stages = build_pipeline(output_dir, manifest, backend=mirror_backend(mirror), incremental=incremental)
+    if fail_stage is not None:
+        def fail(deps):
+            raise RuntimeError(f"{fail_stage} failed")
+        stages[fail_stage] = Stage(stages[fail_stage].deps, fail)
+    results = run_graph(stages)
+    save_manifest(manifest, output_dir)
+    return results
+
+# An incremental run that fails after some stages folded the appended lines into their state, followed
+# by a rerun, gives the same weekly and merged data as a full rebuild: no line is counted twice or lost
+def test_incremental_rerun_after_failure_matches_full_rebuild():
+    with tempfile.TemporaryDirectory() as tmp:
+        raw_files = generate_dataset(os.path.join(tmp, 'raw'), 20_000, 4_000, n_countries=3, start_year=2018, end_year=2022)
+        mirror = os.path.join(tmp, 'mirror')
+        mirror_files = [os.path.join(mirror, WEATHER_DATASET, WEATHER_FILE_NAME),
+                        os.path.join(mirror, FIRE_ALERTS_DATASET, FIRE_ALERTS_FILE_NAME)]
+        lines = []
+        for raw_file, mirror_file in zip(raw_files, mirror_files):
+            os.makedirs(os.path.dirname(mirror_file))
+            with open(raw_file) as f:
+                lines.append(f.readlines())
+
+        # Write the first 3/5 of the lines of each raw file to the mirror, or the rest appended to them
+        def write_mirror(appended):
+            for file_lines, mirror_file in zip(lines, mirror_files):
+                split = len(file_lines) * 3 // 5
+                with open(mirror_file, 'a' if appended else 'w') as f:
+                    f.writelines(file_lines[split:] if appended else file_lines[:split])
+
+        write_mirror(False)
+        write_mirror(True)
+        expected = run_pipeline(os.path.join(tmp, 'full'), mirror, incremental=False)
+        for fail_stage in ['process_fire_alerts_data', 'merge_datasets']:
+            output_dir = os.path.join(tmp, f'incremental_{fail_stage}')
+            write_mirror(False)
+            run_pipeline(output_dir, mirror, incremental=True)
+            write_mirror(True)
+            try:
+                run_pipeline(output_dir, mirror, incremental=True, fail_stage=fail_stage)
+            except RuntimeError:
+                pass
+            else:
+                raise AssertionError(f"{fail_stage} did not fail")
+
+            actual = run_pipeline(output_dir, mirror, incremental=True)
+            for stage in ['process_weather_data', 'process_fire_alerts_data', 'merge_datasets']:
+                pd.testing.assert_frame_equal(actual[stage], expected[stage], check_categorical=False)
+
+# The merge stage merges the weekly weather its dependency hands over, also when it is fed from
+# elsewhere (as pipeline-merged.py does) into a directory without, or with another, weather dataset
+def test_merge_stage_uses_the_weather_it_is_given():
+    with tempfile.TemporaryDirectory() as tmp:
+        weeks = np.arange(40, 53, dtype='int8')
+        weather = pd.DataFrame({'year': np.full(len(weeks), 2018, dtype='int16'), 'week': weeks,
+                                **{column: np.full(len(weeks), 1013.0 if column == 'pressure' else 10.0, dtype='float32')
+                                   for column in WEATHER_MEASUREMENTS}})
+        fire_alerts = pd.DataFrame({'alert__year': np.full(len(weeks), 2018, dtype='int16'), 'alert__week': weeks,
+                                    'alert__count': np.arange(len(weeks), dtype='int32')})
+        for temperature in [19.3, 25.0]:
+            weather['temp.avg'] = np.float32(temperature)
+            stages = build_pipeline(tmp, load_manifest(tmp))
+            merged = run_graph(stages, targets=['merge_datasets'], results={
+                'process_weather_data': weather, 'process_fire_alerts_data': fire_alerts})['merge_datasets']
+            assert merged['week'].tolist() == list(range(41, 53))
+            assert (merged['temp.avg'] == np.float32(temperature)).all()
+
+# The KD-tree finds the k nearest points of every query like a brute-force search over all pairs,
+# also for clustered points, duplicates and queries far from every point
+def test_nearest_matches_brute_force():
+    rng = np.random.default_rng(0)
+    for n_points, n_queries, k in [(1, 50, 1), (7, 200, 3), (500, 1000, 1), (500, 1000, 5), (3000, 500, 2)]:
+        latitude, longitude = rng.uniform(30, 45, n_points), rng.uniform(-10, 30, n_points)
+        latitude[:n_points // 3] = latitude[0]
+        longitude[:n_points // 3] = longitude[0]
+        query_latitude = np.concatenate([rng.uniform(-90, 90, n_queries // 2), rng.uniform(30, 45, n_queries - n_queries // 2)])
+        query_longitude = rng.uniform(-180, 180, n_queries)
+        indices, km = nearest(build_kdtree(latitude, longitude, leaf_size=4), query_latitude, query_longitude, k=k)
+
+        chords = np.linalg.norm(unit_vectors(query_latitude, query_longitude)[:, None, :]
+                                - unit_vectors(latitude, longitude)[None, :, :], axis=2)
+        expected = np.sort(chord_to_km(chords), axis=1)[:, :min(k, n_points)]
+        np.testing.assert_allclose(km, expected, rtol=0, atol=1e-6)
+        found = chord_to_km(np.take_along_axis(chords, indices, axis=1))
+        np.testing.assert_allclose(found, km, rtol=0, atol=1e-6)
+
+# The per-station join only counts the alerts whose nearest station of any country is a station of
+# the selected countries and lies within the maximum distance
+def test_join_stations_excludes_alerts_of_other_countries():
+    stations = {('Greece', 'Athens'): (37.98, 23.73), ('Greece', 'Thessaloniki'): (40.64, 22.94),
+                ('Italy', 'Rome'): (41.90, 12.50), ('Portugal', 'Lisbon'): (38.72, -9.14), ('Spain', 'Madrid'): (40.42, -3.70)}
+    alert_counts = {'Athens': 1, 'Thessaloniki': 10, 'Rome': 100, 'Lisbon': 1000, 'Madrid': 10000}
+    with tempfile.TemporaryDirectory() as tmp:
+        weather_csv, fire_alerts_csv = os.path.join(tmp, 'weather.csv'), os.path.join(tmp, 'fire_alerts.csv')
+        pd.DataFrame([{'country': country, 'city': city, 'date': f'0{day}-03-2020', 'tavg': 15.0, 'tmin': 10.0, 'tmax': 20.0,
+                       'wdir': 180.0, 'wspd': 10.0, 'pres': 1013.0, 'Latitude': latitude, 'Longitude': longitude}
+                      for (country, city), (latitude, longitude) in stations.items() for day in range(2, 9)]
+                     ).to_csv(weather_csv, index=False)
+        rng = np.random.default_rng(0)
+        alerts = [{'iso': country[:3].upper(), 'alert__year': 2020, 'alert__week': 10, 'alert__count': alert_counts[city],
+                   'latitude': latitude + rng.uniform(-0.5, 0.5), 'longitude': longitude + rng.uniform(-0.5, 0.5)}
+                  for (country, city), (latitude, longitude) in stations.items() for _ in range(3)]
+        alerts.append({'iso': 'XXX', 'alert__year': 2020, 'alert__week': 10, 'alert__count': 100000,
+                       'latitude': 30.0, 'longitude': -30.0})
+        pd.DataFrame(alerts).to_csv(fire_alerts_csv, index=False)
+
+        greece = join_stations(weather_csv, fire_alerts_csv, tmp, countries=['Greece']).set_index('city')
+        assert sorted(greece.index) == ['Athens', 'Thessaloniki']
+        assert greece['alert__count'].to_dict() == {'Athens': 3, 'Thessaloniki': 30}
+        everywhere = join_stations(weather_csv, fire_alerts_csv, tmp, countries=None, max_km=500)
+        assert everywhere['alert__count'].sum() == 3 * sum(alert_counts.values())
+        anywhere = join_stations(weather_csv, fire_alerts_csv, tmp, countries=None, max_km=None)
+        assert anywhere['alert__count'].sum() == 3 * sum(alert_counts.values()) + 100000
+
+# The merge takes the weather of the merge country, by default the first aggregated country, and
+# refuses a merge country whose weather is not aggregated
+def test_merge_country_is_one_of_the_aggregated_countries():
+    with tempfile.TemporaryDirectory() as tmp:
+        weather = pd.DataFrame({'country': pd.Categorical(['Greece', 'Italy']), 'year': np.int16(2020), 'week': np.int8(10),
+                                **{column: np.float32(1013.0 if column == 'pressure' else 10.0) for column in WEATHER_MEASUREMENTS}})
+        weather.loc[1, 'temp.avg'] = np.float32(12.5)
+        fire_alerts = pd.DataFrame({'alert__year': [np.int16(2020)], 'alert__week': [np.int8(10)], 'alert__count': [np.int32(7)]})
+        for countries, country in [(['Italy'], None), (['Greece', 'Italy'], 'Italy'), (None, 'Italy')]:
+            stages = build_pipeline(tmp, load_manifest(tmp), countries=countries, country=country)
+            merged = run_graph(stages, targets=['merge_datasets'], results={
+                'process_weather_data': weather, 'process_fire_alerts_data': fire_alerts})['merge_datasets']
+            assert merged['temp.avg'].tolist() == [12.5]
+        try:
+            build_pipeline(tmp, load_manifest(tmp), countries=['Italy'], country='Greece')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("a merge country that is not aggregated was accepted")
+
+# The processing stages give the same output, to the bit, when the raw files are split over worker
+# processes and read in small chunks as when they are read serially in one go
+def test_parallel_processing_matches_serial():
+    with tempfile.TemporaryDirectory() as tmp:
+        weather_csv, fire_alerts_csv = generate_dataset(os.path.join(tmp, 'raw'), 30_000, 5_000, n_countries=5,
+                                                        start_year=2018, end_year=2022, fire_alerts_coordinates=True)
+        outputs = []
+        for processes, chunksize in [(1, 1_000_000), (3, 997)]:
+            output_dir = os.path.join(tmp, f'processes{processes}')
+            outputs.append([
+                process_weather_data(weather_csv, output_dir, countries=None, chunksize=chunksize, processes=processes),
+                process_fire_alerts_data(fire_alerts_csv, output_dir, chunksize=chunksize, processes=processes),
+                join_stations(weather_csv, fire_alerts_csv, output_dir, countries=None, chunksize=chunksize, processes=processes)
+            ])
+        for serial, parallel in zip(*outputs):
+            pd.testing.assert_frame_equal(parallel, serial, check_exact=True)
+
+# Weather readings with more than one decimal are rejected instead of being rounded to tenths
+def test_weather_readings_with_more_decimals_are_rejected():
+    with tempfile.TemporaryDirectory() as tmp:
+        weather_csv = os.path.join(tmp, 'weather.csv')
+        pd.DataFrame({'country': 'Greece', 'date': ['02-03-2020', '03-03-2020'], 'tavg': [15.0, 15.25], 'tmin': 10.0,
+                      'tmax': 20.0, 'wdir': 180.0, 'wspd': 10.0, 'pres': 1013.0}).to_csv(weather_csv, index=False)
+        try:
+            process_weather_data(weather_csv, tmp)
+        except ValueError as e:
+            assert 'tavg' in str(e)
+        else:
+            raise AssertionError("a reading with two decimals was accepted")
+
+# Upserting into SQLite updates changed rows, inserts new ones and deletes the weeks the new
+# DataFrame no longer has, so the table ends up equal to the last DataFrame written
+def test_upsert_sqlite_deletes_stale_rows():
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = connect_sqlite(os.path.join(tmp, 'weekly.db'))
+        first = pd.DataFrame({'country': pd.Categorical(['Greece', 'Greece', 'Italy']), 'year': [2020, 2020, 2020],
+                              'week': [1, 2, 1], 'tavg': np.array([10.5, 11.0, 12.5], dtype='float32')})
+        assert upsert_sqlite(conn, first, 'weather_weekly', ['country', 'year', 'week']) == (3, 0)
+        second = pd.DataFrame({'country': pd.Categorical(['Greece', 'Italy', 'Italy']), 'year': [2020, 2020, 2020],
+                               'week': [1, 1, 2], 'tavg': np.array([10.5, 13.0, 14.5], dtype='float32')})
+        assert upsert_sqlite(conn, second, 'weather_weekly', ['country', 'year', 'week']) == (2, 1)
+        rows = conn.execute('SELECT * FROM weather_weekly ORDER BY country, year, week').fetchall()
+        conn.close()
+        assert rows == [('Greece', 2020, 1, 10.5), ('Italy', 2020, 1, 13.0), ('Italy', 2020, 2, 14.5)], rows
+
+# A mirror holding one dataset file, and a folder to fetch it into
+def fetch_fixture(tmp, content):
+    mirror = os.path.join(tmp, 'mirror')
+    os.makedirs(os.path.join(mirror, 'owner', 'dataset'), exist_ok=True)
+    with open(os.path.join(mirror, 'owner', 'dataset', 'data.csv'), 'wb') as f:
+        f.write(content)
+    output_folder = os.path.join(tmp, 'data')
+    os.makedirs(output_folder, exist_ok=True)
+    return mirror_backend(mirror), output_folder
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+# A local copy matching the remote file is not downloaded again
+def test_fetch_skips_a_matching_local_copy():
+    with tempfile.TemporaryDirectory() as tmp:
+        content = b'date,value\n' + b'01-01-2020,1.0\n' * 1000
+        backend, output_folder = fetch_fixture(tmp, content)
+        local_path, transferred = fetch_file(backend, 'owner/dataset', 'data.csv', output_folder)
+        assert transferred == len(content) and read_bytes(local_path) == content
+        assert fetch_file(backend, 'owner/dataset', 'data.csv', output_folder) == (local_path, 0)
+
+# An interrupted download of the same version of the remote file is resumed where it stopped
+def test_fetch_resumes_a_partial_download_of_the_same_version():
+    with tempfile.TemporaryDirectory() as tmp:
+        content = b'date,value\n' + b'01-01-2020,1.0\n' * 1000
+        backend, output_folder = fetch_fixture(tmp, content)
+        remote = backend.stat('owner/dataset', 'data.csv')
+        partial_path = os.path.join(output_folder, 'data.csv.part')
+        with open(partial_path, 'wb') as f:
+            f.write(content[:5000])
+        with open(f'{partial_path}.json', 'w') as f:
+            json.dump({'size': remote.size, 'version': remote.version}, f)
+        local_path, transferred = fetch_file(backend, 'owner/dataset', 'data.csv', output_folder)
+        assert transferred == len(content) - 5000 and read_bytes(local_path) == content
+        assert not os.path.exists(partial_path) and not os.path.exists(f'{partial_path}.json')
+
+# An interrupted download of a remote file that changed since is restarted from the beginning
+def test_fetch_restarts_a_partial_download_of_a_changed_remote_file():
+    with tempfile.TemporaryDirectory() as tmp:
+        old_content = b'date,value\n' + b'01-01-2020,1.0\n' * 1000
+        backend, output_folder = fetch_fixture(tmp, old_content)
+        old_remote = backend.stat('owner/dataset', 'data.csv')
+        partial_path = os.path.join(output_folder, 'data.csv.part')
+        with open(partial_path, 'wb') as f:
+            f.write(old_content[:5000])
+        with open(f'{partial_path}.json', 'w') as f:
+            json.dump({'size': old_remote.size, 'version': old_remote.version}, f)
+        content = b'date,value\n' + b'02-01-2020,2.0\n' * 1000
+        backend, output_folder = fetch_fixture(tmp, content)
+        local_path, transferred = fetch_file(backend, 'owner/dataset', 'data.csv', output_folder)
+        assert transferred == len(content) and read_bytes(local_path) == content
+
+# Without a remote size or checksum (no Content-Length), the local copy is matched on the ETag it
+# was downloaded with, and downloaded again once the ETag changes
+def test_fetch_matches_on_the_etag_without_a_remote_size():
+    with tempfile.TemporaryDirectory() as tmp:
+        content = b'date,value\n' + b'01-01-2020,1.0\n' * 1000
+        mirror, output_folder = fetch_fixture(tmp, content)
+        etag = ['"v1"']
+        backend = Backend(lambda dataset, file_name: mirror.stat(dataset, file_name)._replace(size=None, checksum=None,
+                                                                                              version=etag[0]),
+                          mirror.open)
+        local_path, transferred = fetch_file(backend, 'owner/dataset', 'data.csv', output_folder)
+        assert transferred == len(content)
+        assert fetch_file(backend, 'owner/dataset', 'data.csv', output_folder) == (local_path, 0)
+        etag[0] = '"v2"'
+        assert fetch_file(backend, 'owner/dataset', 'data.csv', output_folder) == (local_path, len(content))
+
+# A plan reader over a DataFrame, streaming it in chunks of `chunksize` rows like read_csv_chunks
+def frame_reader(df, chunksize):
+    def read(schema, predicate):
+        for start in range(0, len(df), chunksize):
+            chunk = df.iloc[start:start + chunksize][list(schema)].astype(schema)
+            yield chunk if predicate is None else chunk[predicate(chunk)]
+    return read
+
+# A small frame of daily readings and a plan over it with a map, a derive, a dead derive, a select,
+# a rename and a filter on a renamed column, computed again eagerly with pandas
+def plan_fixture():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'country': rng.choice(['Greece', 'Italy', 'Spain'], 500),
+                       'year': rng.integers(2019, 2023, 500), 'tavg': rng.normal(15, 10, 500).round(1),
+                       'tmin': rng.normal(8, 5, 500).round(1), 'unused': rng.normal(size=500)})
+    df.loc[rng.choice(500, 40, replace=False), 'tavg'] = -999.0
+    df.loc[rng.choice(500, 20, replace=False), 'tmin'] = np.nan
+
+    plan = scan({'country': 'object', 'year': 'int64', 'tavg': 'float64', 'tmin': 'float64', 'unused': 'float64'})
+    plan = derive(plan, 'tavg', ['tavg'], lambda get: get('tavg').where(get('tavg') > -100), 'clean tavg')
+    plan = derive(plan, 'trange', ['tavg', 'tmin'], lambda get: get('tavg') - get('tmin'))
+    plan = derive(plan, 'noise', ['unused'], lambda get: get('unused') * 2)
+    plan = isin(plan, 'country', ['Greece', 'Spain'])
+    plan = select(plan, ['country', 'year', 'tavg', 'tmin', 'trange'])
+    plan = rename(plan, {'country': 'nation', 'tavg': 'temperature'})
+    plan = where(plan, ['temperature'], lambda get: get('temperature') < 25, 'temperature < 25')
+    plan = between(plan, 'year', 2020, 2022)
+    plan = aggregate(plan, ['nation', 'year'], {'temperature': 'mean', 'tmin': 'mean', 'trange': 'sum'})
+
+    eager = df.assign(tavg=df['tavg'].where(df['tavg'] > -100))
+    eager = eager.assign(trange=eager['tavg'] - eager['tmin'])
+    eager = eager[eager['country'].isin(['Greece', 'Spain'])].rename(columns={'country': 'nation', 'tavg': 'temperature'})
+    eager = eager[(eager['temperature'] < 25) & eager['year'].between(2020, 2022)]
+    expected = eager.groupby(['nation', 'year']).agg({'temperature': 'mean', 'tmin': 'mean', 'trange': 'sum'})
+    return df, plan, expected, len(eager)
+
+# The optimised plan gives the aggregates of the plan run as written and of pandas run eagerly
+def test_optimized_plan_matches_unoptimized_and_eager():
+    df, plan, expected, expected_rows = plan_fixture()
+    for optimized in (True, False):
+        for chunksize in (37, 500):
+            sums, counts, rows = execute(plan, frame_reader(df, chunksize), optimized=optimized)
+            assert rows == expected_rows
+            pd.testing.assert_frame_equal(finalize(plan, sums, counts)[list(expected.columns)], expected,
+                                          check_dtype=False)
+
+# The optimiser fuses the rename into the aggregation, pushes the filters (including the one on the
+# renamed column, through the map it depends on) down to the scan, drops the select and the dead
+# derive, and projects the scan onto the columns that are read
+def test_optimize_pushes_filters_and_fuses_renames():
+    _, plan, _, _ = plan_fixture()
+    optimized = optimize(plan)
+    assert optimized[0].outputs == ['country', 'year', 'tavg', 'tmin']
+    assert [step.kind for step in optimized[1:]] == ['filter', 'filter', 'filter', 'derive', 'derive', 'aggregate']
+    assert optimized[-1].params['keys'] == ['country', 'year']
+    assert optimized[-1].params['names'] == {'country': 'nation', 'year': 'year', 'tavg': 'temperature',
+                                             'tmin': 'tmin', 'trange': 'trange'}
+    assert not any('noise' in line or 'select' in line or 'rename' in line for line in explain(optimized))
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print(f"{name} passed")
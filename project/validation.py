@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from collections import namedtuple
+
+# Rows per chunk when validating files
+VALIDATION_BATCH_SIZE = 65_536
+
+# A validation check: its name and a function of a chunk returning (violation count, example)
+Check = namedtuple('Check', ['name', 'run'])
+
+# Raised on the first violation in fail-fast mode
+class ValidationError(AssertionError):
+    pass
+
+# The chunk has exactly these columns, in this order
+def schema(columns):
+    expected = list(columns)
+
+    def run(chunk):
+        actual = list(chunk.columns)
+        if actual != expected:
+            return 1, f"columns {actual}, expected {expected}"
+        return 0, None
+    return Check('schema', run)
+
+# No missing values in the columns
+def not_null(columns):
+    columns = list(columns)
+
+    def run(chunk):
+        nulls = chunk[columns].isna()
+        count = int(nulls.to_numpy().sum())
+        if count:
+            return count, f"column {nulls.sum().idxmax()!r} has nulls"
+        return 0, None
+    return Check(f"not_null[{', '.join(columns)}]", run)
+
+# No key occurs twice, across all chunks; keeps the keys seen so far, which for the weekly
+# datasets is one entry per (country,) week
+def unique_key(columns):
+    columns = list(columns)
+    seen = set()
+
+    def run(chunk):
+        keys = list(chunk[columns].itertuples(index=False, name=None))
+        duplicated = pd.Series(keys, dtype=object).duplicated().to_numpy() | np.fromiter(
+            (key in seen for key in keys), dtype=bool, count=len(keys))
+        seen.update(keys)
+        count = int(duplicated.sum())
+        if count:
+            return count, f"duplicate key {keys[int(np.argmax(duplicated))]}"
+        return 0, None
+    return Check(f"unique_key[{', '.join(columns)}]", run)
+
+# Keys are in ascending order, within and across chunks
+def monotonic_key(columns):
+    columns = list(columns)
+    state = {'last': None}
+
+    def run(chunk):
+        if chunk.empty:
+            return 0, None
+        keys = list(chunk[columns].itertuples(index=False, name=None))
+        previous = ([state['last']] if state['last'] is not None else []) + keys[:-1]
+        offset = len(keys) - len(previous)
+        decreasing = [key < before for key, before in zip(keys[offset:], previous)]
+        state['last'] = keys[-1]
+        count = sum(decreasing)
+        if count:
+            return count, f"key {keys[offset + decreasing.index(True)]} after a larger key"
+        return 0, None
+    return Check(f"monotonic_key[{', '.join(columns)}]", run)
+
+# ISO week numbers lie between 1 and 53
+def week_range(column):
+    return value_range(column, 1, 53, name=f"week_range[{column}]")
+
+# Non-null values lie between `low` and `high` (inclusive; None for an open bound)
+def value_range(column, low=None, high=None, name=None):
+    def run(chunk):
+        values = chunk[column]
+        outside = pd.Series(False, index=values.index)
+        if low is not None:
+            outside |= values < low
+        if high is not None:
+            outside |= values > high
+        count = int(outside.sum())
+        if count:
+            return count, f"value {values[outside].iloc[0]} outside [{low}, {high}]"
+        return 0, None
+    return Check(name or f"value_range[{column}]", run)
+
+# Checks of a weekly weather dataset keyed by `keys`; plausible ranges for weekly means
+def weather_weekly_checks(keys=('year', 'week')):
+    measurements = ['temp.avg', 'temp.min', 'temp.max', 'winddir', 'windspd', 'pressure']
+    return [
+        schema(list(keys) + measurements),
+        not_null(list(keys) + measurements),
+        unique_key(keys),
+        monotonic_key(keys),
+        week_range('week'),
+        value_range('temp.avg', -60, 50),
+        value_range('temp.min', -70, 50),
+        value_range('temp.max', -50, 60),
+        value_range('winddir', 0, 360),
+        value_range('windspd', 0, 150),
+        value_range('pressure', 850, 1100)
+    ]
+
+# Checks of the weekly fire alerts dataset
+def fire_alerts_weekly_checks():
+    keys = ['alert__year', 'alert__week']
+    return [
+        schema(keys + ['alert__count']),
+        not_null(keys + ['alert__count']),
+        unique_key(keys),
+        monotonic_key(keys),
+        week_range('alert__week'),
+        value_range('alert__count', 0)
+    ]
+
+# Checks of the merged weekly dataset; left and outer merges leave the weeks missing on one side empty
+def merged_checks(how='inner'):
+    checks = [
+        schema(['year', 'week', 'temp.avg', 'temp.min', 'temp.max', 'winddir', 'windspd', 'pressure', 'alert__count']),
+        *weather_weekly_checks()[1:],
+        not_null(['alert__count']),
+        value_range('alert__count', 0)
+    ]
+    if how != 'inner':
+        checks = [check for check in checks if not check.name.startswith('not_null')]
+    return checks
+
+# Checks of the weekly weather and fire alerts per station; weeks with alerts but without readings
+# have no weather values
+def station_checks():
+    keys = ['country', 'city', 'year', 'week']
+    measurements = ['temp.avg', 'temp.min', 'temp.max', 'winddir', 'windspd', 'pressure']
+    return [
+        schema(['country', 'city', 'latitude', 'longitude', 'year', 'week'] + measurements + ['alert__count']),
+        not_null(keys + ['latitude', 'longitude', 'alert__count']),
+        *weather_weekly_checks(keys)[2:],
+        value_range('latitude', -90, 90),
+        value_range('longitude', -180, 180),
+        value_range('alert__count', 0)
+    ]
+
+# Run the checks over chunks as they pass through, so validation costs no extra pass.
+# Violations are added to `report` (check name -> violation count and first example); in
+# fail-fast mode the first violation raises ValidationError
+def validate_chunks(chunks, checks, report, fail_fast=False, source=''):
+    for chunk in chunks:
+        for check in checks:
+            count, example = check.run(chunk)
+            if not count:
+                continue
+            name = f"{source}: {check.name}" if source else check.name
+            entry = report.setdefault(name, {'violations': 0, 'example': example})
+            entry['violations'] += count
+            if fail_fast:
+                raise ValidationError(f"{name}: {example}")
+        yield chunk
+
+# Validate an in-memory DataFrame and return the violations
+def validate_frame(df, checks, fail_fast=False, source=''):
+    report = {}
+    for _ in validate_chunks([df], checks, report, fail_fast, source):
+        pass
+    return report
+
+# Stream a Parquet file or hive-partitioned dataset (optionally only some columns and rows) or a CSV file
+def iter_file_chunks(path, columns=None, filter=None, batch_size=VALIDATION_BATCH_SIZE):
+    if path.endswith('.csv'):
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=batch_size):
+            yield chunk if columns is None else chunk[columns]
+        return
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    for batch in dataset.to_batches(columns=columns, filter=filter, batch_size=batch_size):
+        yield batch.to_pandas()
+
+# Validate a file chunk by chunk, without loading it whole, and return the violations
+def validate_file(path, checks, columns=None, filter=None, fail_fast=False, source=''):
+    report = {}
+    for _ in validate_chunks(iter_file_chunks(path, columns, filter), checks, report, fail_fast, source or path):
+        pass
+    return report
+
+# Human readable lines of a violations report
+def format_report(report):
+    return [f"{name}: {entry['violations']} violation(s), e.g. {entry['example']}" for name, entry in report.items()]